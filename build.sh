@@ -11,6 +11,10 @@ python manage.py collectstatic --no-input
 # Apply any outstanding database migrations
 python manage.py migrate
 
+# Fill the storefront read models (buy boxes, listing cards, facet counts), the migrations create
+# them empty and a deploy may come after changes that bypassed the signals
+python manage.py rebuild_listings
+
 echo "import os
 from django.contrib.auth.models import User
 username = os.environ.get('DJANGO_SUPERUSER_USERNAME', 'admin')
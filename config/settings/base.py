@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     # Third party apps
     'corsheaders',
     'django.contrib.sites',
@@ -284,6 +285,8 @@ SOCIALACCOUNT_PROVIDERS = {
 STRIPE_TEST_SECRET_KEY = config("STRIPE_TEST_SECRET_KEY")
 STRIPE_WEBHOOK_CONNECTED_SECRET_KEY = config("STRIPE_WEBHOOK_CONNECTED_SECRET_KEY")
 STRIPE_WEBHOOK_PLATFORM_SECRET_KEY = config("STRIPE_WEBHOOK_PLATFORM_SECRET_KEY")
+# empty means api.stripe.com, the storefront tests point it at a local fake stripe
+STRIPE_API_BASE = config("STRIPE_API_BASE", default="")
 
 # why did i do that for, is it for overrriding making jwt token for the user in general in order to always add the role claim to the token ?
 JWT_TOKEN_CLAIMS_SERIALIZER = "sellers.tokens.CustomizedTokenObtainPairSerializer"
@@ -297,4 +300,22 @@ CSRF_TRUSTED_ORIGINS = [
 ]
 
 # checkout expiration time in minutes
-checkout_expiration = 30
\ No newline at end of file
+CHECKOUT_EXPIRATION = 30
+
+# most variations a product may have, the product of the number of values of every variation attribute
+MAX_PRODUCT_VARIATIONS = 1000
+
+# local memory cache for development and tests, production requires redis (REDIS_URL)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+# product detail responses are cached until the product changes, this is only an upper bound
+PRODUCT_CACHE_TIMEOUT = 60 * 60 * 24
+# anonymous carts live in the cache and their cookie expires with them, every change starts the ttl again
+ANONYMOUS_CART_TIMEOUT = 60 * 60 * 24 * 7
+# most units of one offer a cart can hold, adding more (or merging carts at login) stops there
+MAX_CART_QUANTITY = 99
+# priced carts are cached under the cart etag, a changed cart or offer simply misses
+CART_PRICE_CACHE_TIMEOUT = 60 * 60
@@ -1,3 +1,4 @@
+from django.core.exceptions import ImproperlyConfigured
 from .base import *
 
 DATABASES = {
@@ -8,3 +9,15 @@ DATABASES = {
         conn_max_age=600
     )
 }
+
+# every web worker and the task worker must see the same cache, a version token swapped by one process
+# has to reach all of them, so no local memory fallback here
+REDIS_URL = config("REDIS_URL", default=None)
+if not REDIS_URL:
+    raise ImproperlyConfigured("REDIS_URL is required in production, the cache is shared by all processes.")
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+    }
+}
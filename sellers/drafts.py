@@ -0,0 +1,132 @@
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import F, Func, JSONField, TextField, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from rest_framework.permissions import SAFE_METHODS
+from .exceptions import DraftConflictException
+from .models import ProductDraft
+
+# the product wizard keeps its progress in ProductDraft rows, every step loads the working draft
+# of the seller and writes back only the keys it changed
+
+
+def working_draft(seller):
+    """
+    the draft the wizard steps write to, created on first use and loaded once per request
+    """
+    draft = getattr(seller, "_working_draft", None)
+    if draft is None:
+        draft, created = ProductDraft.objects.get_or_create(seller=seller, name="")
+        seller._working_draft = draft
+    return draft
+
+
+def get_draft(seller, name):
+    # a saved draft by name, None when there is no such draft
+    if not name:
+        return None
+    return ProductDraft.objects.filter(seller=seller, name=name).first()
+
+
+def name_draft(seller, name):
+    """
+    store the working draft under name, the next wizard step starts a new working draft
+    """
+    draft = working_draft(seller)
+    draft.name = name
+    draft.save(update_fields=["name", "updated_at"])
+    del seller._working_draft
+    return draft
+
+
+# partial writes
+
+class JSONBSet(Func):
+    function = "jsonb_set"
+    output_field = JSONField()
+
+
+class JSONBPath(Func):
+    # data #> path, the value under a nested key
+    arg_joiner = " #> "
+    template = "(%(expressions)s)"
+    output_field = JSONField()
+
+
+class JSONBConcat(Func):
+    # a || b, the keys of b replace the keys of a
+    arg_joiner = " || "
+    template = "(%(expressions)s)"
+    output_field = JSONField()
+
+
+def json_path(path):
+    return Value(list(path), output_field=ArrayField(TextField()))
+
+
+def json_value(value):
+    return Value(value, output_field=JSONField())
+
+
+def apply_change(data, path, value, merge=False):
+    # the same change on the loaded draft so the caller sees what was written
+    if not path:
+        return {**data, **value} if merge else value
+    *parents, key = path
+    target = data
+    for k in parents:
+        target = target[k]
+    target[key] = {**(target.get(key) or {}), **value} if merge else value
+    return data
+
+
+def update_draft(draft, changes, merge=False):
+    """
+    write {path: value} into the draft data with one UPDATE that sends only the changed keys, path is a
+    tuple of keys, () is the whole data. with merge the keys of value are added to the object at path
+    instead of replacing it. the parent of a path has to exist already.
+    the update only matches the version the draft was loaded with, a draft written by another request
+    in between raises DraftConflictException
+    """
+    data = F("data")
+    for path, value in changes.items():
+        if merge:
+            current = JSONBPath(data, json_path(path)) if path else data
+            value = JSONBConcat(Coalesce(current, json_value({})), json_value(value))
+        else:
+            value = json_value(value)
+        data = JSONBSet(data, json_path(path), value) if path else value
+    updated = ProductDraft.objects.filter(pk=draft.pk, version=draft.version).update(
+        data=data, version=F("version") + 1, updated_at=timezone.now())
+    if not updated:
+        raise DraftConflictException()
+    for path, value in changes.items():
+        draft.data = apply_change(draft.data, path, value, merge)
+    draft.version += 1
+    return draft
+
+
+def draft_etag(draft):
+    return f'"draft-{draft.pk}-{draft.version}"'
+
+
+class DraftVersionMixin:
+    """
+    wizard views, the working draft version goes out as the ETag. a write sent with If-Match of
+    another version is refused instead of overwriting what another tab saved meanwhile
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if_match = request.headers.get("If-Match")
+        if if_match and if_match != "*" and request.method not in SAFE_METHODS:
+            if draft_etag(working_draft(request.user.seller)) != if_match:
+                raise DraftConflictException()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        seller = getattr(request.user, "seller", None)
+        draft = getattr(seller, "_working_draft", None)
+        if draft is not None:
+            response["ETag"] = draft_etag(draft)
+        return response
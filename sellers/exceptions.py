@@ -0,0 +1,8 @@
+from django.utils.translation import gettext as _
+from rest_framework.exceptions import APIException
+
+
+class DraftConflictException(APIException):
+    status_code = 409
+    default_detail = _("The draft was changed in another tab, reload it and try again.")
+    default_code = "draft-conflict"
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from sellers.tasks import run_pending
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the queued background tasks (stripe webhooks). Several workers can run side by side, "
+        "each task is leased to one of them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=20)
+        parser.add_argument("--sleep", type=float, default=1.0,
+                            help="seconds to wait when there is nothing to run")
+        parser.add_argument("--once", action="store_true",
+                            help="run what is due now and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending(options["batch_size"])
+            if count and options["verbosity"] > 1:
+                self.stdout.write(f"ran {count} tasks")
+            if options["once"] and not count:
+                return
+            if not count:
+                time.sleep(options["sleep"])
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0007_sellerproduct_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offer',
+            name='discounted_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='productidentity',
+            name='sripe_product_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='productidentity',
+            name='tax_code',
+            field=models.CharField(default='txcd_32020002', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='productidentity',
+            name='product_type',
+            field=models.CharField(choices=[('over_the_counter_drugs', 'Drugs -> Over The Counter Drugs'), ('prescription_drugs', 'Drugs -> Prescription Drugs'), ('medical_supplies', 'Medicines -> Medical Supplies'), ('clothes', 'Clothes'), ('tshirt', 'Clothes -> T-Shirt'), ('shoes', 'Shoes'), ('electronics', 'Electronics'), ('furniture', 'Furniture'), ('books', 'Books'), ('toys', 'Toys'), ('accessories', 'Accessories'), ('sports_clothes', 'Sports -> Clothes'), ('sports_shoes', 'Sports -> Shoes'), ('jewelry', 'Jewelry'), ('beauty', 'Beauty'), ('automotive', 'Automotive'), ('pet_supplies', 'Pet Supplies'), ('home_appliances', 'Home Appliances'), ('generic', 'Generic'), ('smartphone', 'Electronics -> Smartphone'), ('laptop', 'Electronics -> Laptop')], max_length=50),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:43
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import TextField
+from django.db.models.functions import Cast
+
+
+def fill_search_vector(apps, schema_editor):
+    ProductIdentity = apps.get_model('sellers', 'ProductIdentity')
+    ProductIdentity.objects.update(search_vector=(
+        SearchVector('item_name', weight='A', config='english')
+        + SearchVector('brand_name', weight='A', config='english')
+        + SearchVector('product_type', weight='B', config='english')
+        + SearchVector(Cast('bullet_points', TextField()), weight='C', config='english')
+        + SearchVector('product_description', weight='D', config='english')
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0008_offer_discounted_price_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productidentity',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='productidentity',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='product_search_vector_idx'),
+        ),
+        migrations.RunPython(fill_search_vector, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0009_productidentity_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offer',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='productidentity',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0010_offer_updated_at_productidentity_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='productidentity',
+            index=models.Index(condition=models.Q(('status', 'approved')), fields=['id'], name='approved_product_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productvariation',
+            constraint=models.UniqueConstraint(condition=models.Q(('default', True)), fields=('product_identity',), name='unique_default_variation'),
+        ),
+        migrations.AddConstraint(
+            model_name='sellerproduct',
+            constraint=models.UniqueConstraint(condition=models.Q(('default', True)), fields=('product_identity',), name='unique_default_seller'),
+        ),
+    ]
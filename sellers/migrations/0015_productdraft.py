@@ -0,0 +1,63 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:06
+
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def draft_data_to_drafts(apps, schema_editor):
+    Seller = apps.get_model('sellers', 'Seller')
+    ProductDraft = apps.get_model('sellers', 'ProductDraft')
+    sellers = Seller.objects.exclude(draft_data__isnull=True).exclude(draft_data={})
+    for seller in sellers.only('id', 'draft_data').iterator(chunk_size=500):
+        drafts = [ProductDraft(seller=seller, name='', data=seller.draft_data.get('tmp') or {})]
+        seen = set()
+        for name, data in (seller.draft_data.get('draft_products') or {}).items():
+            # names only differing in case were already refused by SaveDraft, keep the first one anyway
+            if name.lower() in seen:
+                continue
+            seen.add(name.lower())
+            drafts.append(ProductDraft(seller=seller, name=name[:100], data=data or {}))
+        ProductDraft.objects.bulk_create(drafts)
+
+
+def drafts_to_draft_data(apps, schema_editor):
+    Seller = apps.get_model('sellers', 'Seller')
+    ProductDraft = apps.get_model('sellers', 'ProductDraft')
+    draft_data = {}
+    for draft in ProductDraft.objects.order_by('id').iterator(chunk_size=500):
+        data = draft_data.setdefault(draft.seller_id, {'tmp': {}})
+        if draft.name:
+            data.setdefault('draft_products', {})[draft.name] = draft.data
+        else:
+            data['tmp'] = draft.data
+    for seller_id, data in draft_data.items():
+        Seller.objects.filter(pk=seller_id).update(draft_data=data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0014_processedevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDraft',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, default='', max_length=100)),
+                ('data', models.JSONField(blank=True, default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='drafts', to='sellers.seller')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(django.db.models.functions.text.Lower('name'), models.F('seller'), name='unique_seller_draft_name')],
+            },
+        ),
+        migrations.RunPython(draft_data_to_drafts, drafts_to_draft_data),
+        migrations.RemoveField(
+            model_name='seller',
+            name='draft_data',
+        ),
+    ]
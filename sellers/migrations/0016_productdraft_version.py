@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0015_productdraft'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productdraft',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+def possible_variation_to_axes(apps, schema_editor):
+    ProductDraft = apps.get_model('sellers', 'ProductDraft')
+    drafts = ProductDraft.objects.filter(data__has_key='possible_variation')
+    for draft in drafts.iterator(chunk_size=500):
+        themes = [v['theme'] for k, v in sorted(draft.data.pop('possible_variation').items(), key=lambda kv: int(kv[0]))]
+        # values in the order they first show up, an attribute that changes every n ids has
+        # all the attributes changing faster after it, which gives back the order of the axes
+        axes = []
+        for name in (themes[0] if themes else {}):
+            values = list(dict.fromkeys(theme[name] for theme in themes))
+            stride = next((i for i, theme in enumerate(themes) if theme[name] != themes[0][name]), len(themes))
+            axes.append((stride, name, values))
+        draft.data['variation_axes'] = [[name, values] for stride, name, values in sorted(axes, key=lambda a: -a[0])]
+        draft.save(update_fields=['data'])
+
+
+def axes_to_possible_variation(apps, schema_editor):
+    ProductDraft = apps.get_model('sellers', 'ProductDraft')
+    drafts = ProductDraft.objects.filter(data__has_key='variation_axes')
+    for draft in drafts.iterator(chunk_size=500):
+        axes = draft.data.pop('variation_axes')
+        themes = [{}]
+        for name, values in axes:
+            themes = [{**theme, name: value} for theme in themes for value in values]
+        draft.data['possible_variation'] = {str(i): {'theme': theme} for i, theme in enumerate(themes, 1)}
+        draft.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0016_productdraft_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(possible_variation_to_axes, axes_to_possible_variation),
+    ]
@@ -1,5 +1,9 @@
 from django.db import models
+from django.db.models.functions import Lower
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django_countries.fields import CountryField
 from users.models import PaymentMethod
 User = get_user_model()
@@ -89,7 +93,7 @@ STATUS_CHOICES = [
         ("approved", "Approved"),
         ("rejected", "Rejected"),
     ]
-# for performance purposes (related to search) you migh make composite index on status and item_name maybe product_type also idk
+# search goes through the search_vector column (GIN index) instead of a composite index on item_name/product_type
 # for the mean time i will just index status to show products efficiently to the customers 
 class ProductIdentity(models.Model):
     item_name = models.CharField(max_length=300)
@@ -110,10 +114,18 @@ class ProductIdentity(models.Model):
     )
     tax_code = models.CharField(max_length=20, default="txcd_32020002")
     sripe_product_id = models.CharField(max_length=100, blank=True, null=True)
+    # maintained by storefront.catalog.update_search_vector on every save
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
     class Meta:
         permissions = [
             ("can_change_status", "Can Change Status"),
         ]
+        indexes = [
+            GinIndex(fields=["search_vector"], name="product_search_vector_idx"),
+            # approved products walked in id order (listing backfill, review pages)
+            models.Index(fields=["id"], condition=models.Q(status="approved"), name="approved_product_id_idx"),
+        ]
 
 class Seller(models.Model):
     user = models.OneToOneField(
@@ -128,7 +140,6 @@ class Seller(models.Model):
         PaymentMethod, on_delete=models.CASCADE, null=True)
     product = models.ManyToManyField(
         ProductIdentity, related_name="seller", blank=True, through='SellerProduct')
-    draft_data = models.JSONField(default=dict, blank=True, null=True)
 
     class Meta:
         permissions = [
@@ -136,6 +147,25 @@ class Seller(models.Model):
         ]
 
 
+# a product being entered through the wizard, one row per draft so a wizard step rewrites only
+# its own draft. the draft named "" is the working one the steps write to, SaveDraft names it
+class ProductDraft(models.Model):
+    seller = models.ForeignKey(
+        Seller, related_name="drafts", on_delete=models.CASCADE)
+    name = models.CharField(max_length=100, blank=True, default="")
+    # {"ProductIdentity": ..., "variation_axes": ..., "actual_variations": ...}
+    data = models.JSONField(default=dict, blank=True)
+    # bumped by every write, see sellers.drafts.update_draft
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # draft names are case insensitive
+            models.UniqueConstraint(Lower("name"), "seller", name="unique_seller_draft_name"),
+        ]
+
+
 class Store(models.Model):
     seller = models.OneToOneField(
         Seller, related_name="store", on_delete=models.CASCADE)
@@ -150,6 +180,16 @@ class ProductVariation(models.Model):
     theme = models.JSONField(default=dict, blank=True, null=True)
     # images = models.FileField(upload_to='product_images/', blank=True, null=True)
     default = models.BooleanField(default=False)
+    # winning offer, precomputed by storefront.catalog.recompute_buy_box whenever an offer of this variation changes
+    buy_box = models.ForeignKey(
+        "Offer", related_name="+", on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # also the index behind the (product_identity, default=True) lookup
+            models.UniqueConstraint(
+                fields=["product_identity"], condition=models.Q(default=True), name="unique_default_variation"),
+        ]
 
 
 class Offer(models.Model):
@@ -166,6 +206,7 @@ class Offer(models.Model):
         max_length=50, choices=[('FBM', 'Fulfilled by Merchant'), ('FBA', 'Fulfilled by Amazon')], default='FBM')
     discounted_price = models.DecimalField(
         max_digits=10, decimal_places=2, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
     class Meta:
         unique_together = ('PV', 'seller')
 
@@ -179,4 +220,55 @@ class SellerProduct(models.Model):
     default = models.BooleanField(default=False)
     class Meta:
         unique_together = ('seller', 'product_identity')
+        constraints = [
+            # one default seller per product, also serves the (product_identity, default=True) lookup
+            models.UniqueConstraint(
+                fields=["product_identity"], condition=models.Q(default=True), name="unique_default_seller"),
+        ]
+
 
+
+# background work queued in the database (no broker needed), run by `manage.py run_worker`.
+# name is a handler registered in sellers.tasks
+class Task(models.Model):
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+        ],
+        default='queued'
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=8)
+    # next attempt while queued, end of the lease while running
+    run_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["run_at"], condition=models.Q(status__in=["queued", "running"]),
+                         name="pending_task_run_at_idx"),
+        ]
+
+
+# stripe events already accepted by a webhook. a redelivered event hits the unique event_id,
+# an event older than one already accepted for the same object (account, checkout session) is stale,
+# both are dropped by the insert itself, see sellers.tasks.record_event
+class ProcessedEvent(models.Model):
+    event_id = models.CharField(max_length=255, unique=True)
+    object_id = models.CharField(max_length=255)
+    type = models.CharField(max_length=100)
+    created = models.DateTimeField()  # event.created
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["object_id", "created"], name="processed_event_object_idx"),
+        ]
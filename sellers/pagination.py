@@ -0,0 +1,7 @@
+from rest_framework.pagination import LimitOffsetPagination
+
+
+class VariationPagination(LimitOffsetPagination):
+    # pages of sellers.variations.PossibleVariations, any offset costs the same
+    default_limit = 50
+    max_limit = 500
@@ -1,6 +1,7 @@
 from rest_framework.permissions import BasePermission
 from django.core.exceptions import ObjectDoesNotExist 
 from rest_framework.exceptions import PermissionDenied
+from .drafts import get_draft, working_draft
 class is_seller_verified(BasePermission):
     def has_permission(self, request, view):
         try:
@@ -48,7 +49,7 @@ class HasVariations(BasePermission):
 
     def has_permission(self, request, view):
         try:
-            has_variation = request.user.seller.draft_data['tmp']["ProductIdentity"].get("has_variations")
+            has_variation = working_draft(request.user.seller).data["ProductIdentity"].get("has_variations")
         except (KeyError, ObjectDoesNotExist):
             raise PermissionDenied(detail="you need to set product identity first")
         if not has_variation:
@@ -62,7 +63,7 @@ class HasNoVariations(BasePermission):
 
     def has_permission(self, request, view):
         try:
-            has_variation = request.user.seller.draft_data['tmp']["ProductIdentity"].get("has_variations")
+            has_variation = working_draft(request.user.seller).data["ProductIdentity"].get("has_variations")
         except (KeyError, ObjectDoesNotExist):
             raise PermissionDenied(detail="you need to set product identity first")
         if has_variation:
@@ -77,9 +78,10 @@ class ProductInfoCollected(BasePermission):
     def has_permission(self, request, view):
         data = {}
         if request.data.get("draft_name"):
-            data = request.user.seller.draft_data.get('draft_products',None).get(request.data["draft_name"],{})
+            draft = get_draft(request.user.seller, request.data["draft_name"])
+            data = draft.data if draft is not None else {}
         else:
-            data = request.user.seller.draft_data.get('tmp',{})
+            data = working_draft(request.user.seller).data
         if data == {} or data is None:
             raise PermissionDenied(detail="Please enter product info.")
         if data.get("ProductIdentity",None) in [None, ""]:
@@ -1,40 +1,17 @@
 from datetime import datetime
 from rest_framework import serializers
 from django_countries.serializer_fields import CountryField
+from django.conf import settings
+from .drafts import working_draft, update_draft
+from .variations import PossibleVariations, variation_axes, variation_count, variation_theme
 from .models import ProductVariation, Store, Seller, BRAND_CHOICES, PRODUCT_TYPE_CHOICES, AGE_CHOICES, DOSAGE_FORM_CHOICES, PRODUCT_CONDITION_CHOICES
 from users.models import PaymentMethod
 from django_countries.serializers import CountryFieldMixin
 from dj_rest_auth.app_settings import api_settings
 import biip
-import itertools
 import re
 
 
-def generate_variations(attributes):
-
-    # Get the names of the attributes
-    attribute_names = list(attributes.keys())
-    attribute_options = list(attributes.values())
-
-    # Use itertools.product to get all possible combinations
-    combinations = itertools.product(*attribute_options)
-
-    variations = {}
-    id_counter = 1
-
-    # Iterate through each combination to create a variation object
-    for combo in combinations:
-        # Create the theme dictionary
-        theme = {}
-        for name, value in zip(attribute_names, combo):
-            theme[name] = value
-
-        variations[id_counter] = {"theme": theme}
-        id_counter += 1
-
-    return variations
-
-
 class CustomizedJWTSerializer(serializers.Serializer):
     """
     Serializer for JWT authentication.
@@ -147,10 +124,10 @@ class ProductIdentitySerializer(serializers.Serializer):
     brand_name = serializers.ChoiceField(choices=BRAND_CHOICES)
 
     def save(self):
-        seller = self.context['request'].user.seller
-        seller.draft_data['tmp'] = {"ProductIdentity": self.validated_data}
-        seller.draft_data['tmp']["ProductIdentity"].update({"tax_code": get_tax_code(self.validated_data['product_type'])})
-        seller.save()
+        draft = working_draft(self.context['request'].user.seller)
+        identity = {**self.validated_data, "tax_code": get_tax_code(self.validated_data['product_type'])}
+        # a new product identity starts the draft over
+        update_draft(draft, {(): {"ProductIdentity": identity}})
 
 # product variation also part of step 1 u select one serilizer based on product type that logic is implemented in the view
 
@@ -270,7 +247,7 @@ class MedicalVariationSerializer(serializers.Serializer):
     def validate(self, data):
         dosage_form = data.get("dosage_form",None)
         if dosage_form is None:
-            dosage_form = self.context['request'].user.seller.draft_data['tmp']["ProductIdentity"]["product_details"]["dosage_form"]
+            dosage_form = working_draft(self.context['request'].user.seller).data["ProductIdentity"]["product_details"]["dosage_form"]
         Data = [v for v in [data.get("size"), data.get("strength")] if v is not None]
         for value in Data:
             for v in value:
@@ -285,21 +262,23 @@ class MedicalVariationSerializer(serializers.Serializer):
                         raise serializers.ValidationError(
                             f"Invalid unit '{unit}' for solid dosage form. Valid mass units: {VALID_MASS_UNITS}"
                         )
-            
+        count = variation_count(variation_axes({k: v for k, v in data.items() if k != "dosage_form"}))
+        if count > settings.MAX_PRODUCT_VARIATIONS:
+            raise serializers.ValidationError(
+                f"These values make {count} variations, a product can have at most {settings.MAX_PRODUCT_VARIATIONS}.")
         return data
 
     def save(self):
         # this portion of code is used in other variation serializers as well
-        seller = self.context['request'].user.seller
+        draft = working_draft(self.context['request'].user.seller)
         var = self.validated_data
-        seller.draft_data['tmp']["ProductIdentity"].update({
-            "product_details": {"dosage_form": var.pop("dosage_form")}})
-        seller.draft_data['tmp']["ProductIdentity"].update({
-            "product_variations": var})
-        seller.draft_data['tmp'].update({
-            "possible_variation": generate_variations(var)})
-        seller.save()
-        return seller.draft_data['tmp']["possible_variation"]
+        # only the axes are stored, the possible variations are decoded from them when asked for
+        update_draft(draft, {
+            ("ProductIdentity", "product_details"): {"dosage_form": var.pop("dosage_form")},
+            ("ProductIdentity", "product_variations"): var,
+            ("variation_axes",): variation_axes(var),
+        })
+        return draft.data["variation_axes"]
 
 
 # to be continued
@@ -325,6 +304,22 @@ class VariationParametersG2Serializer(serializers.Serializer):
 # based on variation theme make the field reuired or not based on product variations parameters
 
 
+def normalize_gtin(value):
+    # any UPC/EAN/GTIN as the 14 digit GTIN stored in ProductVariation.upc
+    try:
+        return biip.parse(value).gtin.value.zfill(14)
+    except:
+        raise serializers.ValidationError("{} is invalid UPC/GTIN code.".format(value))
+
+
+def taken_upcs(upcs):
+    # the ones already used by a product, one query for any number of codes
+    return set(ProductVariation.objects.filter(upc__in=list(upcs)).values_list("upc", flat=True))
+
+
+UPC_TAKEN = "A product with this UPC/GTIN already exists."
+
+
 class OfferSerializer(serializers.Serializer):
     sku = serializers.CharField(max_length=100)  # offer
     UPC = serializers.CharField( )
@@ -339,13 +334,10 @@ class OfferSerializer(serializers.Serializer):
     default = serializers.BooleanField(default=False)
 
     def validate_UPC(self, value):
-        try:
-            value = biip.parse(value).gtin.value.zfill(14)
-        except:
-            raise serializers.ValidationError("{} is invalid UPC/GTIN code.".format(value))
-        if ProductVariation.objects.filter(upc=value).exists():
-            raise serializers.ValidationError(
-                "A product with this UPC/GTIN already exists.")
+        value = normalize_gtin(value)
+        # OfferWrrapperSerializer checks all its codes with one query
+        if not self.context.get("batch") and taken_upcs([value]):
+            raise serializers.ValidationError(UPC_TAKEN)
         return value
 
     def validate_price(self, value):
@@ -356,11 +348,10 @@ class OfferSerializer(serializers.Serializer):
         return value 
 
     def save(self):
-        seller = self.context['request'].user.seller
+        draft = working_draft(self.context['request'].user.seller)
         var = self.validated_data
         var["theme"] = None
-        seller.draft_data['tmp'].update({"actual_variations": {1: var}})
-        seller.save()
+        update_draft(draft, {("actual_variations",): {1: var}})
         return var
 
 # loop through keys and use serializer to validate each variation
@@ -370,34 +361,43 @@ class OfferWrrapperSerializer(serializers.Serializer):
     variations = serializers.DictField()
 
     def validate(self, data):
-        seller = self.context['request'].user.seller
-        Pvar = seller.draft_data['tmp'].get("possible_variation", None)
-        if Pvar is None:
+        draft = working_draft(self.context['request'].user.seller)
+        axes = draft.data.get("variation_axes", None)
+        if axes is None:
             raise serializers.ValidationError(
                 "you need to set product variations parameters first")
         var = data["variations"]
-        # try and catch clause here in case entered id does not exist in possible variations
-        upc_seen = set()
+        # every variation is validated before anything is reported, the errors come back keyed by variation
+        errors = {}
+        upc_seen = {}
         default_count = 0
         for k , v in var.items():
             if not k.isdigit():
                 raise serializers.ValidationError("Keys must be integers.")
-            offer_serializer = OfferSerializer(data = v)
+            if int(k) not in PossibleVariations(axes):
+                errors[k] = ["{} is not one of the possible variations.".format(k)]
+                continue
+            offer_serializer = OfferSerializer(data = v, context={"batch": True})
             if not offer_serializer.is_valid():
-                raise serializers.ValidationError("Invalid data for variation {}: {}".format(k, offer_serializer.errors))
+                errors[k] = offer_serializer.errors
+                continue
             offer_validated = offer_serializer.validated_data
             if offer_validated["UPC"] in upc_seen:
-                raise serializers.ValidationError("Duplicate UPC found: {} at variation {}".format(v["UPC"], k))
-            upc_seen.add(offer_validated["UPC"])
+                errors[k] = {"UPC": ["Duplicate UPC, variation {} has it too.".format(upc_seen[offer_validated["UPC"]])]}
+                continue
+            upc_seen[offer_validated["UPC"]] = k
             if offer_validated["default"]:
                 default_count += 1
             var[k] = offer_validated
-            var[k]["theme"] = Pvar[k]["theme"]
+            var[k]["theme"] = variation_theme(axes, int(k))
+        for upc in taken_upcs(upc_seen):
+            errors[upc_seen[upc]] = {"UPC": [UPC_TAKEN]}
+        if errors:
+            raise serializers.ValidationError({"variations": errors})
         if default_count != 1:
                 raise serializers.ValidationError(
                     "Only one variant can be default.")
-        seller.draft_data['tmp'].update({"actual_variations": var})
-        seller.save()
+        update_draft(draft, {("actual_variations",): var})
         data["variations"] = var
         return data
 
@@ -415,14 +415,12 @@ class ProductDescriptionSerializer(serializers.Serializer):
         return value
 
     def save(self):
-        seller = self.context['request'].user.seller
+        draft = working_draft(self.context['request'].user.seller)
         var = self.validated_data
-        try:
-            seller.draft_data['tmp']["ProductIdentity"].update(var)
-        except:
+        if "ProductIdentity" not in draft.data:
             raise serializers.ValidationError(
                 "You need to set product identity first")
-        seller.save()
+        update_draft(draft, {("ProductIdentity",): var}, merge=True)
         data = var
         return data
 
@@ -443,7 +441,7 @@ class ClothesDetailsSerializer(serializers.Serializer):
 
     def __init__(self, instance=None, data=..., **kwargs):
         super().__init__(instance, data, **kwargs)
-        var = self.context['request'].user.seller.draft_data['tmp']["variations"]
+        var = working_draft(self.context['request'].user.seller).data["variations"]
         variations = ["size", "color"]
         for key in variations:
             if key in var:
@@ -469,7 +467,7 @@ class MedictDetailsSerializer(serializers.Serializer):
 
     def __init__(self, instance=None, data=..., **kwargs):
         super().__init__(instance, data, **kwargs)
-        var = self.context['request'].user.seller.draft_data['tmp']["ProductIdentity"].get(
+        var = working_draft(self.context['request'].user.seller).data["ProductIdentity"].get(
             "product_variations", None)
         if var is None or var == {}:
             self.fields["dosage_form"] = serializers.ChoiceField(
@@ -577,7 +575,7 @@ class MedictDetailsSerializer(serializers.Serializer):
     def validate(self, data):
         dosage_form = data.get("dosage_form",None)
         if dosage_form is None:
-            dosage_form = self.context['request'].user.seller.draft_data['tmp']["ProductIdentity"]["product_details"]["dosage_form"]
+            dosage_form = working_draft(self.context['request'].user.seller).data["ProductIdentity"]["product_details"]["dosage_form"]
         Data = [v for v in [data.get("size"), data.get("strength")] if v is not None]
         for value in Data:
             unit = value.split()[1]
@@ -594,14 +592,10 @@ class MedictDetailsSerializer(serializers.Serializer):
         return data
 
     def save(self):
-        seller = self.context['request'].user.seller
-        PD = seller.draft_data['tmp']["ProductIdentity"].get("product_details", None)
-        if PD is None:
-            seller.draft_data['tmp']["ProductIdentity"].update({"product_details": self.validated_data})
-        else:
-            seller.draft_data['tmp']["ProductIdentity"]["product_details"].update(self.validated_data)
-        seller.save()
-        return seller.draft_data['tmp']["ProductIdentity"]["product_details"]
+        draft = working_draft(self.context['request'].user.seller)
+        # added to the details already there, or the first details
+        update_draft(draft, {("ProductIdentity", "product_details"): self.validated_data}, merge=True)
+        return draft.data["ProductIdentity"]["product_details"]
 
 
 class SaveDraftSerializer(serializers.Serializer):
@@ -0,0 +1,205 @@
+import logging
+import traceback
+from datetime import datetime, timedelta, timezone as dt_timezone
+import stripe
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from users.models import Customer, PaymentMethod
+from storefront.models import CheckoutItem, Checkout
+from storefront.reservations import consume_checkout, release_checkout
+from .models import ProcessedEvent, Seller, Task
+
+# database backed task queue, webhooks only verify and enqueue, `manage.py run_worker` does the work.
+# a task that raises is retried with exponential backoff until max_attempts, a worker that dies
+# mid task loses its lease and the task is picked up again
+
+logger = logging.getLogger(__name__)
+stripe.api_key = settings.STRIPE_TEST_SECRET_KEY
+
+HANDLERS = {}
+LEASE = timedelta(minutes=5)  # longer than any handler takes
+BACKOFF_BASE = 10  # seconds, doubled on every attempt
+BACKOFF_MAX = 60 * 60
+
+
+def task(name):
+    def register(func):
+        HANDLERS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, payload, run_at=None):
+    if name not in HANDLERS:
+        raise ValueError(f"unknown task {name}")
+    return Task.objects.create(name=name, payload=payload, run_at=run_at or timezone.now())
+
+
+def backoff(attempts):
+    return timedelta(seconds=min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX))
+
+
+def claim(batch_size):
+    """
+    lease up to batch_size due tasks, rows locked by another worker are skipped
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        tasks = list(Task.objects.select_for_update(skip_locked=True).filter(
+            status__in=["queued", "running"], run_at__lte=now).order_by("run_at")[:batch_size])
+        for t in tasks:
+            t.status = "running"
+            t.attempts += 1
+            t.run_at = now + LEASE
+        Task.objects.bulk_update(tasks, ["status", "attempts", "run_at"])
+    return tasks
+
+
+def run_task(t):
+    try:
+        with transaction.atomic():
+            HANDLERS[t.name](t.payload)
+    except Exception:
+        t.last_error = traceback.format_exc()
+        if t.attempts >= t.max_attempts:
+            t.status = "failed"
+            logger.error("task %s (%s) failed for good:\n%s", t.pk, t.name, t.last_error)
+        else:
+            t.status = "queued"
+            t.run_at = timezone.now() + backoff(t.attempts)
+        t.save(update_fields=["status", "run_at", "last_error", "updated_at"])
+        return False
+    t.status = "done"
+    t.save(update_fields=["status", "updated_at"])
+    return True
+
+
+def run_pending(batch_size=20):
+    tasks = claim(batch_size)
+    for t in tasks:
+        run_task(t)
+    return len(tasks)
+
+
+# stripe webhooks, the payload is the verified event as stripe sent it
+
+RECORD_EVENT_SQL = """
+    INSERT INTO {table} (event_id, object_id, type, created, received_at)
+    SELECT %(event_id)s, %(object_id)s, %(type)s, %(created)s, now()
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {table} WHERE object_id = %(object_id)s AND created > %(created)s
+    )
+    ON CONFLICT (event_id) DO NOTHING
+    RETURNING id
+"""
+
+
+def record_event(event):
+    """
+    one insert, True when the event is new and not older than what was already seen for its object
+    """
+    params = {
+        "event_id": event["id"],
+        "object_id": event["data"]["object"].get("id", ""),
+        "type": event["type"],
+        "created": datetime.fromtimestamp(event["created"], tz=dt_timezone.utc),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(RECORD_EVENT_SQL.format(table=ProcessedEvent._meta.db_table), params)
+        return cursor.fetchone() is not None
+
+
+def accept_event(name, event):
+    # duplicates and stale events never reach the queue
+    with transaction.atomic():
+        if not record_event(event):
+            return None
+        return enqueue(name, event)
+
+
+@task("stripe.connected_event")
+def handle_connected_event(event):
+    if event["type"] == 'account.updated':
+        account = event["data"]["object"]
+        # Occurs whenever an account status or property has changed
+        acc = Seller.objects.get(seller_id=account["id"])
+        if account["charges_enabled"] == True and account["payouts_enabled"] == True:
+            acc.PG_verified = True
+            acc.status["onboard"] = True
+            logger.info('stripe_verified is true')
+        elif account["details_submitted"] == True and account["future_requirements"]["past_due"] == []:
+            acc.status["onboard"] = True
+            logger.info('onboard is true')
+        elif account["details_submitted"] == False or account["future_requirements"]["past_due"] is not None:
+            acc.status["onboard"] = False
+            acc.PG_verified = False
+            logger.info('onboard is false')
+        acc.save()
+    else:
+        logger.info('Unhandled event type {}'.format(event["type"]))
+
+
+@task("stripe.platform_event")
+def handle_platform_event(event):
+    if event["type"] == 'setup_intent.succeeded':
+        setup_intent = event["data"]["object"]
+        customer_id = setup_intent["customer"]
+        customer_instance = Customer.objects.get(customer_id=customer_id)
+        user = customer_instance.user
+        pm_id = setup_intent["payment_method"]
+        pm_obj = stripe.Customer.retrieve_payment_method(
+            customer_id,
+            pm_id,
+        )
+        # a retry after a failure further down finds the payment method already stored
+        pm, created = PaymentMethod.objects.get_or_create(
+            Payment_method_id=pm_obj["id"],
+            defaults=dict(
+                card_brand=pm_obj["card"]["brand"],
+                funding=pm_obj["card"]["funding"],
+                last4=pm_obj["card"]["last4"],
+                exp_month=pm_obj["card"]["exp_month"],
+                exp_year=pm_obj["card"]["exp_year"],
+                customer=customer_instance,
+            ),
+        )
+        acc = Seller.objects.get(user=user)
+        acc.pm_sub = pm
+        acc.status["store_pm"] = True
+        acc.save()
+
+    elif event["type"] == 'payment_method.attached':
+        logger.info('PaymentMethod was attached to a Customer!')
+    elif event["type"] == 'checkout.session.completed':
+        session = event["data"]["object"]
+        # every page, a cart has no line limit
+        line_items = list(stripe.checkout.Session.list_line_items(
+            session["id"],
+            limit=100,
+        ).auto_paging_iter())
+        checkout_instance = Checkout.objects.get(payment_session_id=session["id"])
+        checkout_instance.tax = session["total_details"]["amount_tax"]
+        checkout_instance.final_total = session["amount_total"]
+        checkout_instance.shipping_cost = session["total_details"]["amount_shipping"]
+        checkout_instance.discount = session["total_details"]["amount_discount"]
+        checkout_instance.save()
+        # one query for the items, one for the update
+        items = {item.line_item_id: item for item in checkout_instance.items.filter(
+            line_item_id__in=[item["id"] for item in line_items])}
+        for item in line_items:
+            instance = items[item["id"]]
+            instance.tax = item["amount_tax"]
+            instance.total = item["amount_total"]
+        CheckoutItem.objects.bulk_update(items.values(), ["tax", "total"])
+        oversold = consume_checkout(checkout_instance)
+        if oversold:
+            logger.error("checkout %s was paid without stock for offers %s", checkout_instance.pk, oversold)
+    elif event["type"] == 'checkout.session.expired':
+        session = event["data"]["object"]
+        checkout_instance = Checkout.objects.filter(payment_session_id=session["id"]).first()
+        if checkout_instance is not None:
+            # the stock held for it can be sold again
+            release_checkout(checkout_instance)
+    else:
+        logger.info('Unhandled event type {}'.format(event["type"]))
@@ -1,3 +1,378 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import itertools
+import json
+import time
+from datetime import timedelta
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from .drafts import draft_etag, update_draft, working_draft
+from .exceptions import DraftConflictException
+from .models import ProcessedEvent, ProductDraft, Seller, Store, Task
+from .tasks import HANDLERS, LEASE, backoff, claim, enqueue, record_event, run_pending
+from .variations import PossibleVariations, variation_count
 
-# Create your tests here.
+
+def failing(payload):
+    Task.objects.create(name="side effect")  # rolled back with the attempt
+    raise RuntimeError("stripe is down")
+
+
+@mock.patch.dict(HANDLERS, {"test.ok": lambda payload: None, "test.fail": failing})
+class TaskQueueTests(TestCase):
+
+    def overdue(self, task):
+        # what a dead worker leaves behind once its lease ran out, or a backoff that is over
+        Task.objects.filter(pk=task.pk).update(run_at=timezone.now() - timedelta(seconds=1))
+
+    def test_claimed_task_is_leased(self):
+        task = enqueue("test.ok", {})
+        before = timezone.now()
+
+        self.assertEqual([t.pk for t in claim(10)], [task.pk])
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ("running", 1))
+        self.assertGreaterEqual(task.run_at, before + LEASE)
+        # nobody else gets it while the lease runs
+        self.assertEqual(claim(10), [])
+
+        self.overdue(task)
+        self.assertEqual([t.attempts for t in claim(10)], [2])
+
+    def test_done_task_is_not_run_again(self):
+        task = enqueue("test.ok", {})
+
+        self.assertEqual(run_pending(), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.status, "done")
+        self.overdue(task)
+        self.assertEqual(run_pending(), 0)
+
+    def test_failed_attempt_is_retried_with_backoff(self):
+        task = enqueue("test.fail", {})
+        before = timezone.now()
+
+        self.assertEqual(run_pending(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ("queued", 1))
+        self.assertGreaterEqual(task.run_at, before + backoff(1))
+        self.assertIn("stripe is down", task.last_error)
+        self.assertFalse(Task.objects.filter(name="side effect").exists())
+        # not due before the backoff is over
+        self.assertEqual(run_pending(), 0)
+
+        self.overdue(task)
+        run_pending()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ("queued", 2))
+        self.assertGreater(backoff(2), backoff(1))
+
+    def test_task_fails_for_good_after_max_attempts(self):
+        task = enqueue("test.fail", {})
+        Task.objects.filter(pk=task.pk).update(max_attempts=2)
+
+        run_pending()
+        self.overdue(task)
+        with self.assertLogs("sellers.tasks", "ERROR"):
+            run_pending()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ("failed", 2))
+        self.overdue(task)
+        self.assertEqual(run_pending(), 0)
+
+    def test_unknown_task_is_refused(self):
+        with self.assertRaises(ValueError):
+            enqueue("test.unknown", {})
+
+
+def stripe_signature(payload, secret):
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+@override_settings(STRIPE_WEBHOOK_PLATFORM_SECRET_KEY="whsec_test")
+class WebhookTests(TestCase):
+
+    def post_event(self, event, secret="whsec_test"):
+        payload = json.dumps(event)
+        return self.client.post(
+            "/sellers/platform_acc_webhook/", payload, content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=stripe_signature(payload, secret))
+
+    def event(self):
+        return {
+            "id": "evt_1", "object": "event", "type": "checkout.session.expired", "created": 1700000000,
+            "data": {"object": {"id": "cs_test_1", "object": "checkout.session"}},
+        }
+
+    def test_verified_event_is_queued(self):
+        response = self.post_event(self.event())
+
+        self.assertEqual(response.status_code, 200)
+        task = Task.objects.get()
+        self.assertEqual(task.name, "stripe.platform_event")
+        self.assertEqual(task.payload, self.event())
+
+    def test_bad_signature_is_refused(self):
+        response = self.post_event(self.event(), secret="whsec_other")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Task.objects.exists())
+
+
+def stripe_event(event_id, created, object_id="cs_test_1"):
+    return {
+        "id": event_id, "type": "checkout.session.completed", "created": created,
+        "data": {"object": {"id": object_id}},
+    }
+
+
+class RecordEventTests(TestCase):
+
+    def test_duplicate_event_is_refused(self):
+        self.assertTrue(record_event(stripe_event("evt_1", 1700000000)))
+        self.assertFalse(record_event(stripe_event("evt_1", 1700000000)))
+        self.assertEqual(ProcessedEvent.objects.count(), 1)
+
+    def test_older_event_for_the_same_object_is_refused(self):
+        self.assertTrue(record_event(stripe_event("evt_2", 1700000100)))
+        # delivered late, the object already moved on
+        self.assertFalse(record_event(stripe_event("evt_1", 1700000000)))
+        self.assertFalse(ProcessedEvent.objects.filter(event_id="evt_1").exists())
+
+    def test_newer_event_for_the_same_object_is_accepted(self):
+        self.assertTrue(record_event(stripe_event("evt_1", 1700000000)))
+        self.assertTrue(record_event(stripe_event("evt_2", 1700000100)))
+        # other objects are not compared with each other
+        self.assertTrue(record_event(stripe_event("evt_3", 1699999999, object_id="cs_test_2")))
+        self.assertEqual(ProcessedEvent.objects.count(), 3)
+
+
+class UpdateDraftTests(TestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create(username="drafter", email="drafter@example.com")
+        self.seller = Seller.objects.create(user=user, seller_id="acct_drafter", location="US")
+        Store.objects.create(seller=self.seller, name="drafter store")
+        self.draft = working_draft(self.seller)
+
+    def stored(self):
+        return ProductDraft.objects.get(pk=self.draft.pk)
+
+    def test_whole_data_is_replaced(self):
+        update_draft(self.draft, {(): {"ProductIdentity": {"item_name": "Panadol"}}})
+
+        stored = self.stored()
+        self.assertEqual(stored.data, {"ProductIdentity": {"item_name": "Panadol"}})
+        self.assertEqual((stored.version, self.draft.version), (1, 1))
+        self.assertEqual(self.draft.data, stored.data)
+
+    def test_path_write_keeps_the_other_keys(self):
+        update_draft(self.draft, {(): {"ProductIdentity": {"item_name": "Panadol", "brand_name": "eva"}, "offer": 1}})
+        update_draft(self.draft, {("ProductIdentity", "item_name"): "Brufen", ("variation_axes",): ["strength"]})
+
+        expected = {
+            "ProductIdentity": {"item_name": "Brufen", "brand_name": "eva"},
+            "offer": 1, "variation_axes": ["strength"],
+        }
+        self.assertEqual(self.stored().data, expected)
+        self.assertEqual(self.draft.data, expected)
+        self.assertEqual(self.stored().version, 2)
+
+    def test_merge_adds_keys_to_the_object_at_path(self):
+        update_draft(self.draft, {(): {"ProductIdentity": {"item_name": "Panadol", "brand_name": "eva"}}})
+        update_draft(self.draft, {("ProductIdentity",): {"brand_name": "gsk", "strength": "500 mg"}}, merge=True)
+        # a missing key starts from an empty object
+        update_draft(self.draft, {("product_description",): {"bullet_points": ["a"]}}, merge=True)
+
+        expected = {
+            "ProductIdentity": {"item_name": "Panadol", "brand_name": "gsk", "strength": "500 mg"},
+            "product_description": {"bullet_points": ["a"]},
+        }
+        self.assertEqual(self.stored().data, expected)
+        self.assertEqual(self.draft.data, expected)
+
+    def test_stale_version_is_a_conflict(self):
+        other = ProductDraft.objects.get(pk=self.draft.pk)
+        update_draft(other, {("offer",): 1})
+
+        with self.assertRaises(DraftConflictException) as raised:
+            update_draft(self.draft, {("offer",): 2})
+        self.assertEqual(raised.exception.status_code, 409)
+        stored = self.stored()
+        self.assertEqual((stored.data, stored.version), ({"offer": 1}, 1))
+
+    def test_write_with_an_old_etag_is_refused(self):
+        client = APIClient()
+        client.force_authenticate(self.seller.user)
+        etag = client.get("/sellers/set_product_identity/")["ETag"]
+        self.assertEqual(etag, draft_etag(self.draft))
+        update_draft(self.draft, {("offer",): 1})
+
+        response = client.post("/sellers/set_product_identity/", {}, format="json", HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data["detail"].code, "draft-conflict")
+
+
+class PossibleVariationsTests(TestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create(username="varier", email="varier@example.com")
+        self.seller = Seller.objects.create(user=user, seller_id="acct_varier", location="US")
+        Store.objects.create(seller=self.seller, name="varier store")
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.client.post("/sellers/set_product_identity/", {
+            "item_name": "Panadol", "product_type": "medical_supplies", "has_variations": True, "brand_name": "eva",
+        }, format="json")
+
+    def assertDecodesLikeProduct(self, axes):
+        variations = PossibleVariations(axes)
+        names = [name for name, values in axes]
+        expected = [dict(zip(names, theme)) for theme in itertools.product(*(values for name, values in axes))]
+
+        self.assertEqual(len(variations), len(expected))
+        self.assertEqual([variations[i] for i in range(len(variations))],
+                         [{"id": i, "theme": theme} for i, theme in enumerate(expected, 1)])
+        self.assertEqual(variations[2:5], [{"id": i, "theme": expected[i - 1]} for i in range(3, 6)])
+        self.assertNotIn(0, variations)
+        self.assertIn(len(expected), variations)
+        self.assertNotIn(len(expected) + 1, variations)
+        with self.assertRaises(IndexError):
+            variations[len(expected)]
+
+    def test_ids_count_in_mixed_radix(self):
+        self.assertDecodesLikeProduct([["pack_size", ["1", "2"]], ["strength", ["a", "b", "c"]], ["size", ["x", "y", "z", "w"]]])
+
+    def test_at_most_max_product_variations(self):
+        def parameters(packs):
+            return self.client.post("/sellers/set_variation_parameters/", {
+                "dosage_form": "tablet",
+                "pack_size": list(range(1, packs + 1)),
+                "strength": [f"{n} mg" for n in range(10, 510, 10)],
+            }, format="json")
+
+        response = parameters(20)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], settings.MAX_PRODUCT_VARIATIONS)
+        axes = working_draft(self.seller).data["variation_axes"]
+        self.assertEqual(variation_count(axes), settings.MAX_PRODUCT_VARIATIONS)
+        self.assertDecodesLikeProduct(axes)
+
+        # one more pack size is fifty variations too many, the stored axes stay as they were
+        response = parameters(21)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(working_draft(self.seller).data["variation_axes"], axes)
+
+
+class VariationAxesMigrationTests(TransactionTestCase):
+    migrate_from = [("sellers", "0016_productdraft_version")]
+    migrate_to = [("sellers", "0017_draft_variation_axes")]
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.migrate_from)
+        self.old_apps = self.executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_possible_variations_become_axes(self):
+        user = get_user_model().objects.create(username="oldaxes", email="oldaxes@example.com")
+        seller = Seller.objects.create(user=user, seller_id="acct_oldaxes", location="US")
+        axes = [["pack_size", ["1 tablet", "2 tablets"]], ["strength", ["100 mg", "200 mg", "300 mg"]], ["age", ["adult", "child"]]]
+        # every theme was stored, numbered the way itertools.product walks the attributes
+        themes = [dict(zip(["pack_size", "strength", "age"], theme)) for theme in itertools.product(*(v for n, v in axes))]
+        OldProductDraft = self.old_apps.get_model("sellers", "ProductDraft")
+        draft = OldProductDraft.objects.create(seller_id=seller.pk, data={
+            "ProductIdentity": {"item_name": "Panadol"},
+            "possible_variation": {str(i): {"theme": theme} for i, theme in enumerate(themes, 1)},
+        })
+        untouched = OldProductDraft.objects.create(seller_id=seller.pk, name="plain", data={"ProductIdentity": {"item_name": "Brufen"}})
+
+        self.executor.loader.build_graph()
+        self.executor.migrate(self.migrate_to)
+
+        data = ProductDraft.objects.get(pk=draft.pk).data
+        self.assertEqual(data, {"ProductIdentity": {"item_name": "Panadol"}, "variation_axes": axes})
+        self.assertEqual(PossibleVariations(data["variation_axes"])[:], [{"id": i, "theme": theme} for i, theme in enumerate(themes, 1)])
+        self.assertEqual(ProductDraft.objects.get(pk=untouched.pk).data, {"ProductIdentity": {"item_name": "Brufen"}})
+
+
+class ProductDraftMigrationTests(TransactionTestCase):
+    migrate_from = [("sellers", "0014_processedevent")]
+    migrate_to = [("sellers", "0015_productdraft")]
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.migrate_from)
+        self.old_apps = self.executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_draft_data_becomes_drafts(self):
+        OldSeller = self.old_apps.get_model("sellers", "Seller")
+        user = get_user_model().objects.create(username="olddrafts", email="olddrafts@example.com")
+        seller = OldSeller.objects.create(user_id=user.pk, seller_id="acct_olddrafts", location="US", draft_data={
+            "tmp": {"ProductIdentity": {"item_name": "Panadol"}},
+            "draft_products": {
+                "Brufen": {"ProductIdentity": {"item_name": "Brufen"}},
+                "brufen": {"ProductIdentity": {"item_name": "second brufen"}},
+                "x" * 120: None,
+            },
+        })
+        other = get_user_model().objects.create(username="nodrafts", email="nodrafts@example.com")
+        empty = OldSeller.objects.create(user_id=other.pk, seller_id="acct_nodrafts", location="US", draft_data={})
+
+        self.executor.loader.build_graph()
+        self.executor.migrate(self.migrate_to)
+
+        # the model as it is right after the migration, the version field comes later
+        NewProductDraft = self.executor.loader.project_state(self.migrate_to).apps.get_model("sellers", "ProductDraft")
+        drafts = {draft.name: draft.data for draft in NewProductDraft.objects.filter(seller_id=seller.pk)}
+        self.assertEqual(drafts, {
+            "": {"ProductIdentity": {"item_name": "Panadol"}},
+            # the names only differing in case keep the first one
+            "Brufen": {"ProductIdentity": {"item_name": "Brufen"}},
+            "x" * 100: {},
+        })
+        self.assertFalse(NewProductDraft.objects.filter(seller_id=empty.pk).exists())
+
+
+class VariationsOfferTests(TestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create(username="offerer", email="offerer@example.com")
+        self.seller = Seller.objects.create(user=user, seller_id="acct_offerer", location="US")
+        Store.objects.create(seller=self.seller, name="offerer store")
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.client.post("/sellers/set_product_identity/", {
+            "item_name": "Panadol", "product_type": "medical_supplies", "has_variations": True, "brand_name": "eva",
+        }, format="json")
+        self.client.post("/sellers/set_variation_parameters/", {
+            "dosage_form": "tablet", "pack_size": [1, 2], "strength": ["100 mg", "200 mg"],
+        }, format="json")
+
+    def test_errors_are_keyed_by_variation(self):
+        response = self.client.post("/sellers/set_variation_offer/", {"variations": {
+            "1": {"sku": "s1", "UPC": "036000291452", "price": "10.00", "stock": 5, "default": True},
+            "3": {"sku": "s3", "UPC": "012345678905", "price": "ten", "stock": 5},
+        }}, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        errors = response.data["variations"]
+        self.assertEqual(list(errors), ["3"])
+        self.assertIn("price", errors["3"])
+        # nothing is saved while one of them is wrong
+        self.assertNotIn("actual_variations", working_draft(self.seller).data)
@@ -17,6 +17,7 @@ urlpatterns = [
     path("verify_seller/<int:pk>",views.VerifySeller.as_view()),
     path("set_product_identity/",views.ProductIdentityView.as_view()),
     path("set_variation_parameters/",views.VariationParameters.as_view()),
+    path("possible_variations/",views.PossibleVariationsView.as_view()),
     path("set_variation_offer/",views.VariationsOffer.as_view()),
     path("set_one_product_offer/",views.OneProductOffer.as_view()),
     path("set_product_description/",views.ProductDescription.as_view()),
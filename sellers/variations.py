@@ -0,0 +1,47 @@
+from math import prod
+
+# the possible variations of a product are every combination of its attribute values, they are never
+# stored. the draft keeps the axes, [[attribute, [values]], ...], and a variation id is decoded into
+# its theme on demand: ids count in mixed radix, the last attribute changing fastest like
+# itertools.product, and start at 1
+
+
+def variation_axes(attributes):
+    # a list, jsonb does not keep the order of object keys and the ids depend on it
+    return [[name, list(values)] for name, values in attributes.items()]
+
+
+def variation_count(axes):
+    return prod(len(values) for name, values in axes)
+
+
+def variation_theme(axes, variation_id):
+    index = variation_id - 1
+    theme = {}
+    for name, values in reversed(axes):
+        index, digit = divmod(index, len(values))
+        theme[name] = values[digit]
+    return dict(reversed(theme.items()))
+
+
+class PossibleVariations:
+    """
+    lazy sequence of {"id", "theme"}, slicing decodes only the requested ids so it can be paginated
+    """
+
+    def __init__(self, axes):
+        self.axes = axes
+        self.count = variation_count(axes)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, variation_id):
+        return 1 <= variation_id <= self.count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(self.count))]
+        if not 0 <= key < self.count:
+            raise IndexError(key)
+        return {"id": key + 1, "theme": variation_theme(self.axes, key + 1)}
@@ -10,24 +10,28 @@ from django.conf import settings
 from .tokens import CustomizedTokenObtainPairSerializer
 from dj_rest_auth.views import LoginView
 from .jwt_auth import SellerJWTCookieAuthentication
-import json
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from .models import Offer, ProductVariation, Seller, SellerProduct, Store, ProductIdentity
-from users.models import Customer, PaymentMethod
-from .serializers import ClothesDetailsSerializer, LocationSerializer, MedictDetailsSerializer, OfferSerializer, OfferWrrapperSerializer, ProductDescriptionSerializer,PublishDraftSerializer, SaveDraftSerializer
+from users.models import Customer
+from .serializers import UPC_TAKEN, taken_upcs, ClothesDetailsSerializer, LocationSerializer, MedictDetailsSerializer, OfferSerializer, OfferWrrapperSerializer, ProductDescriptionSerializer,PublishDraftSerializer, SaveDraftSerializer
 from dj_rest_auth.app_settings import api_settings as rest_auth_api_settings
 from rest_framework import status
 from .serializers import CustomizedJWTSerializer, StoreInfoSerializer, VerifySellerSerializer, GetSellerSerializer, ProductIdentitySerializer, ClothesVariationSerializer, MedicalVariationSerializer
 from .permissions import HasEmail, HasNoVariations, HasVariations, IsSeller, CanVerify, ProductInfoCollected
 from .generics import UpdateCreateAPIView, ListRetrieveUpdate
 from rest_framework.exceptions import ValidationError
-from storefront.models import CheckoutItem,Checkout
+from .tasks import accept_event
+from storefront.catalog import offers_changed
+from .pagination import VariationPagination
+from .variations import PossibleVariations
+from .drafts import DraftVersionMixin, get_draft, name_draft, update_draft, working_draft
+from django.db import IntegrityError, transaction
 # Create your views here.
 stripe.api_key = settings.STRIPE_TEST_SECRET_KEY
 # manually set the tax code and behavior for products sold through the platform
-settings = stripe.tax.Settings.modify(
+tax_settings = stripe.tax.Settings.modify(
   defaults={"tax_behavior": "exclusive", "tax_code": "txcd_10000000"},
   head_office = {
     "address": {
@@ -342,11 +346,10 @@ class location(GenericAPIView):
         return Response({"platform": "country not supported yet"})
 
 
-@csrf_exempt        # implement the logic after returning the response through using Celery or any other task queue
+@csrf_exempt        # the work happens in sellers.tasks
 def connected_acc_webhook_view(request):
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
-    event = None
 
     try:
         event = stripe.Webhook.construct_event(
@@ -361,41 +364,15 @@ def connected_acc_webhook_view(request):
         print('Error verifying webhook signature: {}'.format(str(e)))
         return HttpResponse(status=400)
 
-    # Handle the event
-    if event.type == 'account.updated':
-        account = event.data.object
-        # Occurs whenever an account status or property has changed
-        print('account property changed {}'.format(event.type))
-        if account["charges_enabled"] == True and account["payouts_enabled"] == True:
-            acc = Seller.objects.get(seller_id=account["id"])
-            acc.PG_verified = True
-            acc.status["onboard"] = True
-            acc.save()
-            print('stripe_verified is true')
-        elif account["details_submitted"] == True and account["future_requirements"]["past_due"] == []:
-            acc = Seller.objects.get(seller_id=account["id"])
-            acc.status["onboard"] = True
-            acc.save()
-            print('onboard is true')
-
-        elif account["details_submitted"] == False or account["future_requirements"]["past_due"] is not None:
-            acc = Seller.objects.get(seller_id=account["id"])
-            acc.status["onboard"] = False
-            acc.PG_verified = False
-            acc.save()
-            print('onboard is false')
-
-    else:
-        print('Unhandled event type {}'.format(event.type))
-
+    # handled by the worker (manage.py run_worker), redelivered and out of date events are dropped here
+    accept_event("stripe.connected_event", event.to_dict())
     return HttpResponse(status=200)
 
 
-@csrf_exempt        # implement the logic after returning the response through using Celery or any other task queue
+@csrf_exempt        # the work happens in sellers.tasks
 def account_webhook_view(request):
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
-    event = None
 
     try:
         event = stripe.Webhook.construct_event(
@@ -410,54 +387,8 @@ def account_webhook_view(request):
         print('Error verifying webhook signature: {}'.format(str(e)))
         return HttpResponse(status=400)
 
-    # Handle the event
-    if event.type == 'setup_intent.succeeded':
-        setup_intent = event.data.object
-        customer_id = setup_intent["customer"]
-        customer_instance = Customer.objects.get(customer_id=customer_id)
-        user = customer_instance.user
-        pm_id = setup_intent["payment_method"]
-        pm_obj = stripe.Customer.retrieve_payment_method(
-            customer_id,
-            pm_id,
-        )
-        pm = PaymentMethod.objects.create(
-            Payment_method_id=pm_obj["id"],
-            card_brand=pm_obj["card"]["brand"],
-            funding=pm_obj["card"]["funding"],
-            last4=pm_obj["card"]["last4"],
-            exp_month=pm_obj["card"]["exp_month"],
-            exp_year=pm_obj["card"]["exp_year"],
-            customer=customer_instance
-        )
-        acc = Seller.objects.get(user=user)
-        acc.pm_sub = pm
-        acc.status["store_pm"] = True
-        acc.save()
-
-    elif event.type == 'payment_method.attached':
-        payment_method = event.data.object  # contains a stripe.PaymentMethod
-        print('PaymentMethod was attached to a Customer!')
-    elif event.type == 'checkout.session.completed':
-        session = event.data.object
-        line_items = stripe.checkout.Session.list_line_items(
-            session.id,
-            limit = 100,
-        )
-        checkout_instance = Checkout.objects.get(payment_session_id = session.id)
-        checkout_instance.tax = session["total_details"]["amount_tax"]
-        checkout_instance.final_total= session["amount_total"]
-        checkout_instance.shipping_cost = session["total_details"]["amount_shipping"]
-        checkout_instance.discount = session["total_details"]["amount_discount"]
-        checkout_instance.save()
-        for item in line_items:
-            instance =CheckoutItem.objects.get(line_item_id = item["data"]["id"])
-            instance.tax = item["data"]["taxes"]
-            instance.total =item["data"]["amount_total"]
-            instance.save()
-    else:
-        print('Unhandled event type {}'.format(event.type))
-
+    # handled by the worker (manage.py run_worker), redelivered and out of date events are dropped here
+    accept_event("stripe.platform_event", event.to_dict())
     return HttpResponse(status=200)
 
 
@@ -483,7 +414,7 @@ class VerifySeller(ListRetrieveUpdate):
 # the process creating a product
 
 
-class ProductIdentityView(GenericAPIView):
+class ProductIdentityView(DraftVersionMixin, GenericAPIView):
     authentication_classes = [SellerJWTCookieAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = ProductIdentitySerializer
@@ -491,7 +422,7 @@ class ProductIdentityView(GenericAPIView):
     def get(self, request):
         seller = request.user.seller
         try:
-            PI = seller.draft_data['tmp'].get("ProductIdentity", {})
+            PI = working_draft(seller).data.get("ProductIdentity", {})
             return Response(PI)
         except:
             return Response({}, status=204)
@@ -508,12 +439,12 @@ MEDICAL = ['medicines', 'medical_equipment', 'medical_supplies',
            'medical_devices', 'medical_instruments']
 
 
-class VariationParameters(APIView):
+class VariationParameters(DraftVersionMixin, APIView):
     authentication_classes = [SellerJWTCookieAuthentication]
     permission_classes = [permissions.IsAuthenticated, HasVariations]
 
     def get_serializer_class(self):
-        product_type = self.request.user.seller.draft_data['tmp']["ProductIdentity"]["product_type"]
+        product_type = working_draft(self.request.user.seller).data["ProductIdentity"]["product_type"]
         if product_type in CLOTHES:
             return ClothesVariationSerializer
         elif product_type in MEDICAL:
@@ -522,7 +453,7 @@ class VariationParameters(APIView):
             return Response({"error": "product type not supported"}, status=400)
 
     def get(self, request):
-        pv = request.user.seller.draft_data["tmp"]["ProductIdentity"].get(
+        pv = working_draft(request.user.seller).data["ProductIdentity"].get(
             "product_variations", None)
         if pv is not None:
             return Response(pv)
@@ -542,17 +473,31 @@ class VariationParameters(APIView):
         serializer = serializer_class(
             data=request.data, context={"request": request})
         serializer.is_valid(raise_exception=True)
-        data = serializer.save()
-        return Response(data)
+        variations = PossibleVariations(serializer.save())
+        # the first page of the possible variations, the rest through PossibleVariationsView
+        return Response({"count": len(variations), "results": variations[:VariationPagination.default_limit]})
 
 
-class OneProductOffer(GenericAPIView):
+class PossibleVariationsView(DraftVersionMixin, GenericAPIView):
+    authentication_classes = [SellerJWTCookieAuthentication]
+    permission_classes = [permissions.IsAuthenticated, HasVariations]
+    pagination_class = VariationPagination
+
+    def get(self, request):
+        axes = working_draft(request.user.seller).data.get("variation_axes", None)
+        if axes is None:
+            return Response({"error": "you need to set product variations parameters first"}, status=400)
+        page = self.paginate_queryset(PossibleVariations(axes))
+        return self.get_paginated_response(page)
+
+
+class OneProductOffer(DraftVersionMixin, GenericAPIView):
     authentication_classes = [SellerJWTCookieAuthentication]
     permission_classes = [permissions.IsAuthenticated, HasNoVariations]
     serializer_class = OfferSerializer
 
     def get(self, request):
-        var = request.user.seller.draft_data["tmp"].get(
+        var = working_draft(request.user.seller).data.get(
             "actual_variations", None)
         if var:
             return Response(var["1"])
@@ -567,13 +512,13 @@ class OneProductOffer(GenericAPIView):
         return Response(data)
 
 
-class VariationsOffer(GenericAPIView):
+class VariationsOffer(DraftVersionMixin, GenericAPIView):
     authentication_classes = [SellerJWTCookieAuthentication]
     permission_classes = [permissions.IsAuthenticated, HasVariations]
     serializer_class = OfferWrrapperSerializer
 
     def get(self, request):
-        var = request.user.seller.draft_data["tmp"].get(
+        var = working_draft(request.user.seller).data.get(
             "actual_variations", None)
         if var is not None:
             return Response(var)
@@ -586,13 +531,13 @@ class VariationsOffer(GenericAPIView):
         return Response(serializer.validated_data)
 
 
-class ProductDescription(GenericAPIView):
+class ProductDescription(DraftVersionMixin, GenericAPIView):
     authentication_classes = [SellerJWTCookieAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = ProductDescriptionSerializer
 
     def get(self, request):
-        PI = request.user.seller.draft_data['tmp']["ProductIdentity"]
+        PI = working_draft(request.user.seller).data["ProductIdentity"]
         if PI.get("product_description", None) is not None:
             return Response({"product_description": PI["product_description"], "bullet_points": PI["bullet_points"]})
         else:
@@ -605,13 +550,13 @@ class ProductDescription(GenericAPIView):
         return Response(data)
 
 
-class ProductDetails(GenericAPIView):
+class ProductDetails(DraftVersionMixin, GenericAPIView):
     authentication_classes = [SellerJWTCookieAuthentication]
     permission_classes = [permissions.IsAuthenticated,]
 
     def get_serializer_class(self):
         try:
-            PI = self.request.user.seller.draft_data['tmp']["ProductIdentity"]
+            PI = working_draft(self.request.user.seller).data["ProductIdentity"]
             if PI["has_variations"] and not PI.get("product_variations", None):
                 return ValidationError({"error": "set variation first"})
         except Exception:
@@ -625,7 +570,7 @@ class ProductDetails(GenericAPIView):
 
     def get(self, request):
         serializer_class = self.get_serializer()
-        PI = self.request.user.seller.draft_data['tmp']["ProductIdentity"]
+        PI = working_draft(self.request.user.seller).data["ProductIdentity"]
         if PI.get("product_details", {}) .get("active_ingredients") is not None:
             return Response(PI["product_details"])
         fields = serializer_class.fields
@@ -644,33 +589,55 @@ class ProductDetails(GenericAPIView):
         return Response(data)
 
 def save_to_db(seller, data):
-    PI = ProductIdentity.objects.create(**data["ProductIdentity"])
-    SellerProduct.objects.create(
-            seller=seller,
-            product_identity=PI,
-            variations=data["ProductIdentity"].get("product_variations", {}),
-            default = True,
-        )
+    """
+    publish a draft, all or nothing, in a fixed number of queries whatever the number of variations
+    """
     variations = data["actual_variations"]
-    for k in variations.keys():
-        PV = ProductVariation.objects.create(
-            product_identity=PI,
-            upc=variations[k]["UPC"],
-            theme=variations[k]["theme"],
-            default=variations[k].get("default", False)
-        )
-        Offer.objects.create(
-            sku=variations[k]["sku"],
-            price=variations[k]["price"],
-            stock=variations[k]["stock"],
-            PV=PV,
-            seller=seller,
-            fullfillment_channel=variations[k]["fullfilled_by"],
-            condition=variations[k]["condition"],
-        )
-        PI.status = "pending"
-        PI.save()
-        
+    # the codes were free when the offers were entered, a draft can sit for a while
+    upcs = {v["UPC"]: k for k, v in variations.items()}
+    taken = taken_upcs(upcs)
+    if taken:
+        raise ValidationError({"variations": {upcs[upc]: {"UPC": [UPC_TAKEN]} for upc in taken}})
+    with transaction.atomic():
+        # created pending right away, its save signal indexes it for search once
+        PI = ProductIdentity.objects.create(**data["ProductIdentity"], status="pending")
+        SellerProduct.objects.create(
+                seller=seller,
+                product_identity=PI,
+                variations=data["ProductIdentity"].get("product_variations", {}),
+                default = True,
+            )
+        try:
+            # another publish can take a code after the check above, the unique upc catches it
+            with transaction.atomic():
+                PVs = ProductVariation.objects.bulk_create([
+                    ProductVariation(
+                        product_identity=PI,
+                        upc=v["UPC"],
+                        theme=v["theme"],
+                        default=v.get("default", False)
+                    )
+                    for v in variations.values()
+                ])
+        except IntegrityError:
+            raise ValidationError({"variations": UPC_TAKEN})
+        by_upc = {PV.upc: PV for PV in PVs}
+        Offer.objects.bulk_create([
+            Offer(
+                sku=v["sku"],
+                price=v["price"],
+                stock=v["stock"],
+                PV=by_upc[v["UPC"]],
+                seller=seller,
+                fullfillment_channel=v["fullfilled_by"],
+                condition=v["condition"],
+            )
+            for v in variations.values()
+        ])
+        # bulk_create sends no post_save, do what the variation and offer signals would
+        offers_changed(by_upc[upc].pk for upc in by_upc)
+    return PI
+
 
 class PublishProduct(GenericAPIView):
     authentication_classes = [SellerJWTCookieAuthentication]
@@ -682,22 +649,22 @@ class PublishProduct(GenericAPIView):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         draft_name = serializer.validated_data.get('draft_name', None)
-        tmp_data = seller.draft_data.get("tmp", {})
-        if draft_name and tmp_data:
+        tmp = working_draft(seller)
+        if draft_name and tmp.data:
             return Response({"error": "no product to publish please re-enter product info"}, status=400)
         if draft_name:
-            data = seller.draft_data.get("draft_products", {}).get(draft_name, None)
-            if data is None:
+            draft = get_draft(seller, draft_name)
+            if draft is None:
                 return Response({"error": f"draft name {draft_name} does not exist"}, status=400)
-            save_to_db(seller , data)
-            seller.draft_data["draft_products"].pop(draft_name)
-            seller.save()
+            # the draft goes with the publish, a second publish of it finds nothing
+            with transaction.atomic():
+                save_to_db(seller , draft.data)
+                draft.delete()
             return Response({"message": f" product will get reviewed soon, we will notify you when the product is approved and published"})
         else:
-            data = tmp_data
-            save_to_db(seller,data)
-            seller.draft_data["tmp"] = {}
-            seller.save()
+            with transaction.atomic():
+                save_to_db(seller, tmp.data)
+                update_draft(tmp, {(): {}})
             return Response({"message": f" product will get reviewed soon, we will notify you when the product is approved and published"})
 
 
@@ -717,27 +684,23 @@ class SaveDraft(GenericAPIView):
     def get(self, request, *args, **kwargs):
         seller = request.user.seller
         if kwargs.get('pk', None):
-            data = seller.draft_data.get(
-                "draft_products", {}).get(kwargs['pk'], None)
-            return Response(data)
-        drafts = seller.draft_data.get("draft_products", {})
-        draft_names = []
-        for draft_name in drafts.keys():
-            draft_names.append(draft_name)
-        return Response(draft_names)
+            draft = get_draft(seller, kwargs['pk'])
+            return Response(draft.data if draft is not None else None)
+        # names only, the draft data is not loaded
+        draft_names = seller.drafts.exclude(name="").order_by("id").values_list("name", flat=True)
+        return Response(list(draft_names))
 
     def post(self, request):
         seller = request.user.seller    
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         draft_name = serializer.validated_data['draft_name']
-        if seller.draft_data.get("draft_products", None) is None:
-            seller.draft_data["draft_products"] = {
-                draft_name: seller.draft_data["tmp"]}
-        else:
-            if draft_name.lower() in (k.lower() for k in seller.draft_data["draft_products"].keys()):
-                return Response({"error": "draft name {} already exists".format(draft_name)}, status=400)
-            seller.draft_data["draft_products"][draft_name] = seller.draft_data["tmp"]
-        seller.draft_data["tmp"] = {}
-        seller.save()
+        # the working draft is renamed in place, its data is not copied
+        if seller.drafts.filter(name__iexact=draft_name).exists():
+            return Response({"error": "draft name {} already exists".format(draft_name)}, status=400)
+        try:
+            with transaction.atomic():
+                name_draft(seller, draft_name)
+        except IntegrityError:
+            return Response({"error": "draft name {} already exists".format(draft_name)}, status=400)
         return Response({"message": f"draft {draft_name} saved successfully"})
@@ -0,0 +1,151 @@
+import secrets
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from sellers.models import Offer
+from .catalog import new_version
+from .models import Cart, CartLine
+
+# carts of signed in users are CartLine rows, anonymous shoppers get a cart in the cache under a
+# random token carried by a signed cookie, browsing never touches the cart table. the cache has to
+# be shared by every process and outlive deploys, production settings refuse to start without redis.
+# the anonymous cart is merged into the persistent one at login
+
+CART_COOKIE = "cart"
+CART_COOKIE_SALT = "storefront.cart"
+
+
+def offer_snapshot(offer):
+    # offer needs PV__product_identity and seller__store loaded
+    return {
+        "product_identity": offer.PV.product_identity_id,
+        "product_variation": offer.PV_id,
+        "theme": offer.PV.theme,
+        "item_name": offer.PV.product_identity.item_name,
+        "store": offer.seller.store.name,
+    }
+
+
+def cart_line(cart, offer, quantity=1):
+    snapshot = offer_snapshot(offer)
+    return CartLine(
+        cart=cart,
+        offer=offer,
+        quantity=quantity,
+        product_identity_id=snapshot["product_identity"],
+        product_variation_id=snapshot["product_variation"],
+        theme=snapshot["theme"],
+        item_name=snapshot["item_name"],
+        store=snapshot["store"],
+    )
+
+
+def upsert_cart_lines(lines):
+    # a single INSERT ... ON CONFLICT, adding an offer that is already in the cart resets its line
+    return CartLine.objects.bulk_create(
+        lines,
+        update_conflicts=True,
+        unique_fields=["cart", "offer"],
+        update_fields=["quantity", "product_identity", "product_variation",
+                       "theme", "item_name", "store", "updated_at"],
+    )
+
+
+class SessionCart:
+    """
+    cart of an anonymous shopper, {offer id: snapshot with the count} like the cart lines render it
+    """
+
+    def __init__(self, request):
+        try:
+            self.token = request.get_signed_cookie(
+                CART_COOKIE, salt=CART_COOKIE_SALT, max_age=settings.ANONYMOUS_CART_TIMEOUT)
+        except (KeyError, signing.BadSignature):
+            self.token = None
+        stored = cache.get(self.key) if self.token else None
+        if stored is None:
+            stored = {"items": {}, "version": None}
+        self.items = stored["items"]
+        # changes with every write, see storefront.pricing
+        self.version = stored["version"]
+
+    @property
+    def key(self):
+        return f"cart:anonymous:{self.token}"
+
+    def save(self):
+        if self.token is None:
+            self.token = secrets.token_urlsafe(24)
+        self.version = new_version()
+        # every write starts the ttl again, abandoned carts just expire
+        cache.set(self.key, {"items": self.items, "version": self.version},
+                  settings.ANONYMOUS_CART_TIMEOUT)
+
+    def set_cookie(self, response):
+        if self.token is not None:
+            response.set_signed_cookie(
+                CART_COOKIE, self.token, salt=CART_COOKIE_SALT, max_age=settings.ANONYMOUS_CART_TIMEOUT,
+                httponly=True, samesite="Lax", secure=not settings.DEBUG)
+        return response
+
+    def add(self, offers, quantities):
+        for pk, quantity in quantities.items():
+            self.items[str(pk)] = {"count": quantity, **offer_snapshot(offers[pk])}
+        self.save()
+
+    def increment(self, offer_id):
+        item = self.items.get(str(offer_id))
+        if item is None:
+            return False
+        item["count"] = min(item["count"] + 1, settings.MAX_CART_QUANTITY)
+        self.save()
+        return True
+
+    def decrement(self, offer_id):
+        item = self.items.get(str(offer_id))
+        if item is None:
+            return False
+        if item["count"] > 1:
+            item["count"] -= 1
+        else:
+            del self.items[str(offer_id)]
+        self.save()
+        return True
+
+    def remove(self, offer_id):
+        if self.items.pop(str(offer_id), None) is None:
+            return False
+        self.save()
+        return True
+
+    def clear(self):
+        self.items = {}
+        self.version = None
+        if self.token is not None:
+            cache.delete(self.key)
+
+
+def merge_session_cart(request, user):
+    """
+    move the anonymous cart into the user cart, quantities of offers found in both add up to the cap
+    """
+    session_cart = SessionCart(request)
+    if not session_cart.items:
+        return None
+    instance, created = Cart.objects.get_or_create(user=user)
+    ids = [int(pk) for pk in session_cart.items]
+    # offers deleted while the cart sat in the cache are dropped
+    offers = Offer.objects.select_related("PV__product_identity", "seller__store").in_bulk(ids)
+    existing = dict(instance.lines.filter(offer_id__in=ids).values_list("offer_id", "quantity"))
+    upsert_cart_lines([
+        cart_line(instance, offers[pk], min(
+            existing.get(pk, 0) + session_cart.items[str(pk)]["count"], settings.MAX_CART_QUANTITY))
+        for pk in ids if pk in offers
+    ])
+    session_cart.clear()
+    return instance
+
+
+def forget_session_cart(response):
+    response.delete_cookie(CART_COOKIE, samesite="Lax")
+    return response
@@ -0,0 +1,335 @@
+import time
+import uuid
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import TextField, F, Count, Case, When, Value, CharField, Q
+from django.db.models.functions import Cast
+from sellers.models import ProductIdentity, ProductVariation, Offer, Task
+from .models import ProductListing, FacetCount, FACET_CHOICES
+
+SEARCH_CONFIG = "english"
+
+
+def search_vector():
+    # weights drive the ranking, a hit in the name counts more than a hit in the description
+    return (
+        SearchVector("item_name", weight="A", config=SEARCH_CONFIG)
+        + SearchVector("brand_name", weight="A", config=SEARCH_CONFIG)
+        + SearchVector("product_type", weight="B", config=SEARCH_CONFIG)
+        + SearchVector(Cast("bullet_points", TextField()), weight="C", config=SEARCH_CONFIG)
+        + SearchVector("product_description", weight="D", config=SEARCH_CONFIG)
+    )
+
+
+def update_search_vector(product_ids):
+    # update() does not send post_save so this can be called from the save signal
+    ProductIdentity.objects.filter(pk__in=product_ids).update(
+        search_vector=search_vector())
+
+
+def get_default_variation(product):
+    if product.has_variations:
+        return product.variations.filter(default=True).first()
+    return product.variations.order_by("id").first()
+
+
+def refresh_listing(product_id):
+    """
+    rebuild the listing card of one product, the card only exists while the product is approved
+    """
+    with transaction.atomic():
+        # the product row lock serializes refreshes of the same product (it exists before the card does),
+        # every refresh shifts the facet counters from the card the previous one left, never twice from the same
+        product = ProductIdentity.objects.select_for_update().filter(pk=product_id).first()
+        if product is None or product.status != "approved":
+            ProductListing.objects.filter(pk=product_id).delete()
+            return None
+
+        var = get_default_variation(product)
+        offer = None
+        if var is not None and var.buy_box_id is not None:
+            offer = Offer.objects.select_related(
+                "seller__store").filter(pk=var.buy_box_id).first()
+
+        card = {
+            "item_name": product.item_name,
+            "brand_name": product.brand_name,
+            "product_type": product.product_type,
+            "product_variations": product.product_variations,
+            "default_theme": var.theme if var is not None and product.has_variations else None,
+            "offer_id": offer.pk if offer else None,
+            "price": offer.price if offer else None,
+            "stock": offer.stock if offer else 0,
+            "condition": offer.condition if offer else "",
+            "store_name": offer.seller.store.name if offer else "",
+        }
+        current = ProductListing.objects.filter(pk=product_id).first()
+        if current is not None and all(getattr(current, field) == value for field, value in card.items()):
+            # nothing on the card changed (say the stock of an offer that isn't the buy box), the catalog stays valid
+            return current
+        listing, created = ProductListing.objects.update_or_create(product_identity=product, defaults=card)
+        shift_facets(listing_facets(current), listing_facets(listing))
+        invalidate_catalog()
+    return listing
+
+
+# buy box
+
+CONDITION_RANK = {"new": 0, "refurbished": 1, "used": 2}
+CHANNEL_RANK = {"FBA": 0, "FBM": 1}
+
+
+def buy_box_key(offer):
+    # in stock first, then the cheapest effective price, better condition, then fulfillment channel
+    price = offer.discounted_price if offer.discounted_price is not None else offer.price
+    return (
+        offer.stock <= 0,
+        price,
+        CONDITION_RANK.get(offer.condition, len(CONDITION_RANK)),
+        CHANNEL_RANK.get(offer.fullfillment_channel, len(CHANNEL_RANK)),
+        offer.pk,
+    )
+
+
+def recompute_buy_box(variation_ids):
+    """
+    pick the winning offer of each variation and store it, returns the ids of the products whose winner changed
+    """
+    with transaction.atomic():
+        # the variation row locks, taken in id order, serialize recomputes of the same variation.
+        # the offers are read once they are held, the last one to store a winner has seen the latest offers
+        variations = list(ProductVariation.objects.select_for_update().filter(
+            pk__in=list(variation_ids)).order_by("id").only("id", "buy_box", "product_identity"))
+        winners = {}
+        offers = Offer.objects.filter(PV_id__in=[var.pk for var in variations]).only(
+            "id", "PV_id", "price", "discounted_price", "stock", "condition", "fullfillment_channel")
+        for offer in offers:
+            current = winners.get(offer.PV_id)
+            if current is None or buy_box_key(offer) < buy_box_key(current):
+                winners[offer.PV_id] = offer
+
+        changed = []
+        for var in variations:
+            winner = winners.get(var.pk)
+            winner_id = winner.pk if winner is not None else None
+            if var.buy_box_id != winner_id:
+                var.buy_box_id = winner_id
+                changed.append(var)
+        ProductVariation.objects.bulk_update(changed, ["buy_box"])
+    return {var.product_identity_id for var in changed}
+
+
+def offers_changed(variation_ids):
+    """
+    what the offer signals do, for offers written with update() (stock reservations) which send no post_save
+    """
+    variation_ids = list(variation_ids)
+    product_ids = set(ProductVariation.objects.filter(pk__in=variation_ids).values_list(
+        "product_identity_id", flat=True))
+    recompute_buy_box(variation_ids)
+    invalidate_product(product_ids)
+    for product_id in product_ids:
+        refresh_listing(product_id)
+
+
+REFRESH_PRODUCT_TASK = "catalog.refresh_product"
+
+
+def queue_product_refresh(product_ids):
+    """
+    let the worker recompute the buy boxes and the listing card of these products (storefront.tasks),
+    for stock changes that would otherwise all queue on the same product row lock. one queued task per
+    product, a change made while it waits is picked up when it runs. call it once the change is committed
+    """
+    product_ids = set(product_ids)
+    queued = set(Task.objects.filter(
+        name=REFRESH_PRODUCT_TASK, status="queued", payload__product_id__in=list(product_ids)
+    ).values_list("payload__product_id", flat=True))
+    Task.objects.bulk_create(
+        Task(name=REFRESH_PRODUCT_TASK, payload={"product_id": pk}) for pk in product_ids - queued)
+
+
+def variation_product_id(variation_id):
+    # the variation may already be gone when an offer is deleted through a cascade
+    return ProductVariation.objects.filter(pk=variation_id).values_list(
+        "product_identity_id", flat=True).first()
+
+
+def rebuild_listings():
+    variation_ids = ProductVariation.objects.values_list("id", flat=True)
+    batch = []
+    for variation_id in variation_ids.iterator():
+        batch.append(variation_id)
+        if len(batch) == 1000:
+            recompute_buy_box(batch)
+            batch = []
+    recompute_buy_box(batch)
+    ProductListing.objects.exclude(
+        product_identity__status="approved").delete()
+    approved = ProductIdentity.objects.filter(
+        status="approved").values_list("id", flat=True)
+    count = 0
+    for product_id in approved.iterator():
+        refresh_listing(product_id)
+        count += 1
+    rebuild_facets()
+    return count
+
+
+# facets
+
+PRICE_RANGES = ((0, 10), (10, 25), (25, 50), (50, 100), (100, 250), (250, None))
+
+
+def price_range_label(low, high):
+    return f"{low}+" if high is None else f"{low}-{high}"
+
+
+def price_range(price):
+    if price is None:
+        return None
+    for low, high in PRICE_RANGES:
+        if high is None or price < high:
+            return price_range_label(low, high)
+
+
+def listing_facets(listing):
+    if listing is None:
+        return {}
+    return {
+        "product_type": listing.product_type or None,
+        "brand_name": listing.brand_name or None,
+        "condition": listing.condition or None,
+        "price_range": price_range(listing.price),
+        "in_stock": "true" if listing.stock > 0 else "false",
+    }
+
+
+def shift_facets(old, new):
+    """
+    move the counters of a listing card from its old facet values to the new ones, untouched values cost nothing
+    """
+    for facet, _ in FACET_CHOICES:
+        old_value, new_value = old.get(facet), new.get(facet)
+        if old_value == new_value:
+            continue
+        if old_value is not None:
+            FacetCount.objects.filter(facet=facet, value=old_value).update(
+                count=F("count") - 1)
+        if new_value is not None:
+            FacetCount.objects.bulk_create(
+                [FacetCount(facet=facet, value=new_value)], ignore_conflicts=True)
+            FacetCount.objects.filter(facet=facet, value=new_value).update(
+                count=F("count") + 1)
+
+
+def price_range_case():
+    whens = []
+    for low, high in PRICE_RANGES:
+        condition = Q(price__gte=low)
+        if high is not None:
+            condition &= Q(price__lt=high)
+        whens.append(When(condition, then=Value(price_range_label(low, high))))
+    return Case(*whens, default=None, output_field=CharField())
+
+
+def count_facets(queryset):
+    """
+    facet counts of an arbitrary set of listing cards, one GROUP BY per facet on the listing table only
+    """
+    queryset = queryset.order_by().annotate(
+        price_range=price_range_case(),
+        in_stock=Case(When(stock__gt=0, then=Value("true")),
+                      default=Value("false"), output_field=CharField()),
+    )
+    facets = {}
+    for facet, _ in FACET_CHOICES:
+        rows = queryset.values(facet).annotate(count=Count("pk"))
+        facets[facet] = {row[facet]: row["count"]
+                         for row in rows if row[facet] not in (None, "")}
+    return facets
+
+
+def stored_facets():
+    facets = {facet: {} for facet, _ in FACET_CHOICES}
+    for row in FacetCount.objects.filter(count__gt=0).values("facet", "value", "count"):
+        facets[row["facet"]][row["value"]] = row["count"]
+    return facets
+
+
+def rebuild_facets():
+    """
+    recount the facets from the listing cards. the table lock waits for the refreshes that already
+    shifted a counter and holds off the next ones until the new counts are in, the cards are only read
+    once it is held so no shift lands between the count and the swap. readers keep the old counts meanwhile
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {FacetCount._meta.db_table} IN EXCLUSIVE MODE")
+        FacetCount.objects.all().delete()
+        FacetCount.objects.bulk_create(
+            FacetCount(facet=facet, value=value, count=count)
+            for facet, values in count_facets(ProductListing.objects.all()).items()
+            for value, count in values.items()
+        )
+
+
+# version tokens
+# cached entries are keyed by a version token, invalidating only swaps the token so stale
+# entries become unreachable and simply expire. the token starts with the time it was issued,
+# which doubles as the Last-Modified of whatever it versions. tokens expire too (never before
+# what they version), a token issued again is only a miss
+
+def new_version():
+    return f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+
+
+def version_time(version):
+    return datetime.fromtimestamp(int(version.split("-")[0]) / 1e9, tz=dt_timezone.utc)
+
+
+def get_version(key, create=True):
+    version = cache.get(key)
+    if version is None and create:
+        cache.add(key, new_version(), settings.PRODUCT_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_versions(keys):
+    # swap the tokens once the change is committed, otherwise a concurrent read could cache the old data again
+    versions = {key: new_version() for key in keys}
+    transaction.on_commit(lambda: cache.set_many(versions, settings.PRODUCT_CACHE_TIMEOUT))
+
+
+def product_version_key(product_id):
+    return f"product:{product_id}:version"
+
+
+def product_version(product_id, create=True):
+    return get_version(product_version_key(product_id), create)
+
+
+def invalidate_product(product_ids):
+    bump_versions(product_version_key(pk) for pk in product_ids)
+
+
+def catalog_version():
+    # changes whenever any listing card changes
+    return get_version("catalog:version")
+
+
+def invalidate_catalog():
+    bump_versions(["catalog:version"])
+
+
+def get_cached_product_detail(product_id):
+    return cache.get(f"product:{product_id}:detail", version=product_version(product_id))
+
+
+def cache_product_detail(product_id, data):
+    cache.set(f"product:{product_id}:detail", data,
+              settings.PRODUCT_CACHE_TIMEOUT, version=product_version(product_id))
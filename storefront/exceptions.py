@@ -0,0 +1,24 @@
+from django.utils.translation import gettext as _
+from rest_framework.exceptions import APIException
+
+
+class OutOfStockException(APIException):
+    status_code = 409
+    default_detail = _("Some items are out of stock.")
+    default_code = "out-of-stock"
+
+    def __init__(self, offer_ids):
+        super().__init__({"detail": self.default_detail, "offers": offer_ids})
+        self.offer_ids = offer_ids
+
+
+class CheckoutConflictException(APIException):
+    status_code = 409
+    default_detail = _("This checkout is no longer open, start a new one.")
+    default_code = "checkout-conflict"
+
+
+class PaymentProviderException(APIException):
+    status_code = 502
+    default_detail = _("The payment provider could not complete the checkout, try again.")
+    default_code = "payment-provider-error"
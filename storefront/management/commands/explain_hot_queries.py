@@ -0,0 +1,92 @@
+import uuid
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from sellers.models import ProductIdentity, ProductVariation, Offer, Seller, SellerProduct, Store
+from storefront.models import ProductListing
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Run EXPLAIN on the storefront hot queries and fail if any of them falls back to a sequential scan. "
+        "--seed N fills the catalog with N synthetic products first, everything is rolled back at the end"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0,
+                            help="number of synthetic products to create before explaining")
+
+    def handle(self, *args, **options):
+        failures = []
+        try:
+            with transaction.atomic():
+                if options["seed"]:
+                    self.seed(options["seed"])
+                failures = self.explain_all(options["verbosity"])
+                raise Rollback
+        except Rollback:
+            pass
+        if failures:
+            raise CommandError("sequential scan in: {}".format(", ".join(failures)))
+        self.stdout.write(self.style.SUCCESS("all hot queries use an index"))
+
+    def hot_queries(self):
+        product = ProductIdentity.objects.filter(status="approved").order_by("id").first()
+        offer = Offer.objects.order_by("id").first()
+        if product is None or offer is None:
+            raise CommandError("no approved product to explain with, run with --seed")
+        return {
+            "default seller": SellerProduct.objects.filter(product_identity=product, default=True),
+            "default variation": ProductVariation.objects.filter(product_identity=product, default=True),
+            "offer by variation and seller": Offer.objects.filter(PV_id=offer.PV_id, seller_id=offer.seller_id),
+            "approved products by id": ProductIdentity.objects.filter(status="approved").order_by("id")[:24],
+            "listing page": ProductListing.objects.filter(pk__gt=product.pk).order_by("pk")[:24],
+        }
+
+    def explain_all(self, verbosity):
+        failures = []
+        for name, queryset in self.hot_queries().items():
+            plan = queryset.explain()
+            if verbosity > 1:
+                self.stdout.write(f"{name}:\n{plan}\n")
+            if "Seq Scan" in plan:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f"{name}: sequential scan"))
+            else:
+                self.stdout.write(f"{name}: ok")
+        return failures
+
+    def seed(self, count):
+        tag = uuid.uuid4().hex[:8]
+        user = User.objects.create(username=f"explain-{tag}", email=f"explain-{tag}@example.com")
+        seller = Seller.objects.create(user=user, seller_id=f"acct_explain_{tag}", location="US")
+        Store.objects.create(seller=seller, name=f"explain {tag}")
+
+        # bulk_create skips the catalog signals, the listing cards are written directly below
+        products = ProductIdentity.objects.bulk_create(
+            ProductIdentity(item_name=f"product {i}", product_type="generic", brand_name="generic",
+                            has_variations=True, status="approved" if i % 10 else "pending")
+            for i in range(count)
+        )
+        SellerProduct.objects.bulk_create(
+            SellerProduct(seller=seller, product_identity=p, default=True) for p in products)
+        variations = ProductVariation.objects.bulk_create(
+            ProductVariation(product_identity=p, upc=f"9{p.pk:09d}{v}", default=v == 0)
+            for p in products for v in range(2)
+        )
+        Offer.objects.bulk_create(
+            Offer(sku=f"sku-{var.pk}", price=10, stock=5, PV=var, seller=seller) for var in variations)
+        ProductListing.objects.bulk_create(
+            ProductListing(product_identity=p, item_name=p.item_name, brand_name=p.brand_name)
+            for p in products if p.status == "approved"
+        )
+        with connection.cursor() as cursor:
+            for model in [ProductIdentity, SellerProduct, ProductVariation, Offer, ProductListing]:
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+        self.stdout.write(f"seeded {count} products")
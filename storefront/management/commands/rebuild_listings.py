@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from storefront.catalog import rebuild_listings
+
+
+class Command(BaseCommand):
+    help = "Recompute the buy boxes, then rebuild the listing cards of all approved products and the facet counts"
+
+    def handle(self, *args, **options):
+        count = rebuild_listings()
+        self.stdout.write(self.style.SUCCESS(f"rebuilt {count} listing cards"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from storefront.reservations import release_expired
+
+
+class Command(BaseCommand):
+    help = (
+        "Give the stock of expired checkout reservations back to their offers, in batches. "
+        "Safe to run from several workers at once (cron it every minute)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = release_expired(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"released {count} reservations"))
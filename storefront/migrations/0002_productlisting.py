@@ -0,0 +1,74 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0008_offer_discounted_price_and_more'),
+        ('storefront', '0001_initial'),
+        ('users', '0011_address_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cart', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='Checkout',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subtotal', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('shipping_cost', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('discount', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('final_total', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('tax', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('payment_session_id', models.CharField(max_length=255)),
+                ('status', models.CharField(default='pending', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField()),
+                ('soft_expires_at', models.DateTimeField()),
+                ('payment_method', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='used_checkout', to='users.paymentmethod')),
+                ('shipping_address', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='used_checkout', to='users.address')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CheckoutItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('quantity', models.PositiveIntegerField()),
+                ('discounted_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('tax', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('status', models.CharField(choices=[('available', 'Available'), ('unavailable', 'Unavailable'), ('price_changed', 'Price Changed')], default='available', max_length=20)),
+                ('checkout', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='storefront.checkout')),
+                ('offer', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, to='sellers.offer')),
+                ('product_identity', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='sellers.productidentity')),
+                ('product_variation', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='sellers.productvariation')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='sellers.store')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductListing',
+            fields=[
+                ('product_identity', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='listing', serialize=False, to='sellers.productidentity')),
+                ('item_name', models.CharField(max_length=300)),
+                ('brand_name', models.CharField(max_length=50)),
+                ('product_variations', models.JSONField(blank=True, default=dict, null=True)),
+                ('default_theme', models.JSONField(blank=True, null=True)),
+                ('price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('stock', models.PositiveIntegerField(default=0)),
+                ('store_name', models.CharField(blank=True, max_length=100)),
+                ('offer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='sellers.offer')),
+            ],
+        ),
+    ]
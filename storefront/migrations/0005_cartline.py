@@ -0,0 +1,80 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def carts_to_lines(apps, schema_editor):
+    Cart = apps.get_model('storefront', 'Cart')
+    CartLine = apps.get_model('storefront', 'CartLine')
+    Offer = apps.get_model('sellers', 'Offer')
+    for cart in Cart.objects.exclude(items={}).iterator():
+        items = cart.items or {}
+        # offers that were deleted since they were added are dropped
+        offers = Offer.objects.select_related('PV__product_identity', 'seller__store').in_bulk(
+            [int(pk) for pk in items.keys()])
+        CartLine.objects.bulk_create([
+            CartLine(
+                cart=cart,
+                offer=offer,
+                quantity=max(int(items[key].get('count', 1)), 1),
+                product_identity=offer.PV.product_identity,
+                product_variation=offer.PV,
+                theme=offer.PV.theme,
+                item_name=offer.PV.product_identity.item_name,
+                store=offer.seller.store.name,
+            )
+            for key in items.keys()
+            for offer in [offers.get(int(key))] if offer is not None
+        ], ignore_conflicts=True)
+
+
+def lines_to_carts(apps, schema_editor):
+    Cart = apps.get_model('storefront', 'Cart')
+    for cart in Cart.objects.prefetch_related('lines').iterator(chunk_size=500):
+        cart.items = {
+            str(line.offer_id): {
+                'count': line.quantity,
+                'product_identity': line.product_identity_id,
+                'product_variation': line.product_variation_id,
+                'theme': line.theme,
+                'item_name': line.item_name,
+                'store': line.store,
+            }
+            for line in cart.lines.all()
+        }
+        cart.save(update_fields=['items'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0012_productvariation_buy_box'),
+        ('storefront', '0004_cart_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=1)),
+                ('theme', models.JSONField(blank=True, null=True)),
+                ('item_name', models.CharField(max_length=300)),
+                ('store', models.CharField(max_length=100)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('cart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='storefront.cart')),
+                ('offer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cart_lines', to='sellers.offer')),
+                ('product_identity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='sellers.productidentity')),
+                ('product_variation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='sellers.productvariation')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('cart', 'offer'), name='unique_cart_offer')],
+            },
+        ),
+        migrations.RunPython(carts_to_lines, lines_to_carts),
+        migrations.RemoveField(
+            model_name='cart',
+            name='items',
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sellers', '0012_productvariation_buy_box'),
+        ('storefront', '0006_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkoutitem',
+            name='line_item_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='checkoutitem',
+            name='offer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='checkout_items', to='sellers.offer'),
+        ),
+    ]
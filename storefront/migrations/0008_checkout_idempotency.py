@@ -0,0 +1,40 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storefront', '0007_checkoutitem_line_item_id'),
+        ('users', '0011_address_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkout',
+            name='cart_version',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='checkout',
+            name='client_secret',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='checkout',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='checkout',
+            name='payment_session_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='checkout',
+            index=models.Index(fields=['user', 'status'], name='storefront__user_id_774e54_idx'),
+        ),
+    ]
@@ -1,5 +1,3 @@
-from datetime import timedelta
-from time import timezone
 from django.db import models
 from django.contrib.auth import get_user_model
 from sellers.models import ProductIdentity, ProductVariation, Store, Offer
@@ -9,9 +7,73 @@ User = get_user_model()
 
 class Cart(models.Model):
     user = models.OneToOneField(User,related_name="cart", on_delete=models.CASCADE)
-    items = models.JSONField(default=dict)  # List of item IDs or details
+    updated_at = models.DateTimeField(auto_now=True)  # has to be listed in update_fields
 
 
+# one row per offer in a cart, every cart change touches a single row (quantities move with F())
+# so two tabs editing the same cart don't overwrite each other
+class CartLine(models.Model):
+    cart = models.ForeignKey(Cart, related_name="lines", on_delete=models.CASCADE)
+    offer = models.ForeignKey(Offer, related_name="cart_lines", on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+    # snapshot of the offer when it was added, the price is always read from the offer
+    product_identity = models.ForeignKey(ProductIdentity, related_name="+", on_delete=models.CASCADE)
+    product_variation = models.ForeignKey(ProductVariation, related_name="+", on_delete=models.CASCADE)
+    theme = models.JSONField(blank=True, null=True)
+    item_name = models.CharField(max_length=300)
+    store = models.CharField(max_length=100)
+    updated_at = models.DateTimeField(auto_now=True)  # set it explicitly in update()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["cart", "offer"], name="unique_cart_offer"),
+        ]
+
+
+# read model for the listing page, one row per approved product
+# rows are rebuilt by storefront.catalog whenever the product, its variations or offers change
+class ProductListing(models.Model):
+    product_identity = models.OneToOneField(
+        ProductIdentity, related_name="listing", on_delete=models.CASCADE, primary_key=True)
+    item_name = models.CharField(max_length=300)
+    brand_name = models.CharField(max_length=50)
+    product_type = models.CharField(max_length=50, blank=True)
+    product_variations = models.JSONField(default=dict, blank=True, null=True)
+    default_theme = models.JSONField(blank=True, null=True)
+    offer = models.ForeignKey(
+        Offer, related_name="+", on_delete=models.SET_NULL, null=True, blank=True)
+    price = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True)
+    stock = models.PositiveIntegerField(default=0)
+    condition = models.CharField(max_length=50, blank=True)
+    store_name = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["product_type", "price"]),
+            models.Index(fields=["brand_name", "price"]),
+            models.Index(fields=["price"]),
+        ]
+
+
+FACET_CHOICES = [
+    ("product_type", "Product Type"),
+    ("brand_name", "Brand Name"),
+    ("condition", "Condition"),
+    ("price_range", "Price Range"),
+    ("in_stock", "In Stock"),
+]
+
+
+# number of listed products per facet value, shifted by storefront.catalog whenever a listing card changes
+class FacetCount(models.Model):
+    facet = models.CharField(max_length=20, choices=FACET_CHOICES)
+    value = models.CharField(max_length=50)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('facet', 'value')
+
 
 class Checkout(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -19,22 +81,32 @@ class Checkout(models.Model):
     shipping_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     discount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     final_total = models.DecimalField(max_digits=10, decimal_places=2,default=0) # total_price + shipping_cost + tax - discount
-    shipping_address = models.ForeignKey(Address, on_delete=models.SET_NULL, related_name='used_checkout')#this shit is wrong
+    shipping_address = models.ForeignKey(Address, on_delete=models.SET_NULL, related_name='used_checkout', null=True)#this shit is wrong
     tax = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     payment_method = models.ForeignKey(PaymentMethod,on_delete=models.SET_NULL,related_name="used_checkout",null=True,blank=True)
-    payment_session_id = models.CharField(max_length=255,)
+    payment_session_id = models.CharField(max_length=255, unique=True)
+    client_secret = models.CharField(max_length=255, blank=True)
+    # a pending checkout is handed out again while the cart stays the same or for the same Idempotency-Key
+    cart_version = models.CharField(max_length=255, blank=True)
+    idempotency_key = models.CharField(max_length=255, blank=True)
     status = models.CharField(max_length=20, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at=models.DateTimeField()
     soft_expires_at = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "status"]),
+        ]
+
 
 class CheckoutItem(models.Model):
     checkout = models.ForeignKey(Checkout, related_name='items', on_delete=models.CASCADE)
     product_identity = models.ForeignKey(ProductIdentity, on_delete=models.PROTECT)
     product_variation = models.ForeignKey(ProductVariation, on_delete=models.PROTECT)
-    offer = models.OneToOneField(Offer,on_delete=models.PROTECT) # what if the seller deletes the offer or somehow the stock is over
-    store = models.ForeignKey(Store,on_delete=models.PROTECT)    # we have to prevent this senario
+    offer = models.ForeignKey(Offer,related_name="checkout_items",on_delete=models.PROTECT) # stock is held by StockReservation
+    store = models.ForeignKey(Store,on_delete=models.PROTECT)
+    line_item_id = models.CharField(max_length=255, blank=True, db_index=True)  # stripe line item, set once the session exists
     name = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     quantity = models.PositiveIntegerField()
@@ -49,4 +121,30 @@ class CheckoutItem(models.Model):
             ('price_changed', 'Price Changed'),
         ],
         default='available'
-    )
\ No newline at end of file
+    )
+
+# stock taken off an offer for the lifetime of a checkout, the offer stock is decremented when the
+# reservation is made so the remaining stock is always what can still be sold.
+# held reservations are released when the checkout expires (see storefront.reservations)
+class StockReservation(models.Model):
+    checkout = models.ForeignKey(Checkout, related_name="reservations", on_delete=models.CASCADE)
+    offer = models.ForeignKey(Offer, related_name="reservations", on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            ('held', 'Held'),
+            ('released', 'Released'),
+            ('consumed', 'Consumed'),
+        ],
+        default='held'
+    )
+    expires_at = models.DateTimeField()  # same as the checkout
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # the sweeper only looks at held reservations
+            models.Index(fields=["expires_at"], condition=models.Q(status="held"),
+                         name="held_reservation_expiry_idx"),
+        ]
@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class ProductCursorPagination(CursorPagination):
+    """
+    keyset pagination on the product id, every page costs the same no matter how deep the cursor is
+    """
+    ordering = "pk"
+    page_size = 24
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+
+class SearchPagination(LimitOffsetPagination):
+    # results are ordered by rank, shoppers rarely go past the first pages
+    default_limit = 24
+    max_limit = 100
@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+from sellers.models import Offer
+from .cart import SessionCart
+from .catalog import version_time
+
+# a priced cart is cached under the cart etag, the etag changes with any line and with any
+# offer the cart points to, so a cached price is never served after a price change
+
+
+def cart_validators(instance):
+    """
+    etag and last modified of a persistent or an anonymous cart, one aggregate query
+    """
+    if isinstance(instance, SessionCart):
+        offers = Offer.objects.filter(pk__in=[int(pk) for pk in instance.items]).aggregate(
+            count=Count("pk"), updated_at=Max("updated_at"))
+        timestamps = [offers["updated_at"]]
+        if instance.version is not None:
+            timestamps.append(version_time(instance.version))
+        last_modified = max(filter(None, timestamps), default=None)
+        changed = offers["updated_at"].timestamp() if offers["updated_at"] else None
+        etag = f'cart-{instance.token}-{instance.version}-{offers["count"]}-{changed}'
+        return etag, last_modified
+
+    # every line change moves its updated_at or the line count
+    lines = instance.lines.aggregate(
+        count=Count("pk"), quantity=Sum("quantity"),
+        updated_at=Max("updated_at"), offer_updated_at=Max("offer__updated_at"))
+    last_modified = max(filter(None, [instance.updated_at, lines["updated_at"], lines["offer_updated_at"]]))
+    etag = f'cart-{instance.pk}-{lines["count"]}-{lines["quantity"]}-{last_modified.timestamp()}'
+    return etag, last_modified
+
+
+def cart_items(instance):
+    # {offer id: snapshot with the count}
+    if isinstance(instance, SessionCart):
+        return instance.items
+    return {
+        str(line.offer_id): {
+            "count": line.quantity,
+            "product_identity": line.product_identity_id,
+            "product_variation": line.product_variation_id,
+            "theme": line.theme,
+            "item_name": line.item_name,
+            "store": line.store,
+        }
+        for line in instance.lines.order_by("id")
+    }
+
+
+def compute_cart_price(instance):
+    items = cart_items(instance)
+    # the only offer query, offers deleted since they were added are skipped
+    offers = Offer.objects.only("id", "price", "discounted_price").in_bulk(
+        [int(pk) for pk in items])
+    priced_items = {}
+    subtotal = 0
+    discount = 0
+    for item_id, item_data in items.items():
+        offer = offers.get(int(item_id))
+        if offer is None:
+            continue
+        count = item_data["count"]
+        unit_price = offer.discounted_price if offer.discounted_price is not None else offer.price
+        line_total = unit_price * count
+        priced_items[item_id] = {
+            **item_data,
+            "price": offer.price,
+            "discounted_price": offer.discounted_price,
+            "line_total": line_total,
+        }
+        subtotal += line_total
+        discount += (offer.price - unit_price) * count
+    return {"items": priced_items, "subtotal_price": subtotal, "discount": discount}
+
+
+def price_cart(instance, etag=None):
+    """
+    items with their line totals, the discount and the subtotal of a cart, recomputed only when the cart
+    or one of its offers changed. pass the etag when the caller already has it
+    """
+    if isinstance(instance, SessionCart):
+        if not instance.items:
+            return {"items": {}, "subtotal_price": 0, "discount": 0}
+        key = f"cart:anonymous:{instance.token}:priced"
+    else:
+        key = f"cart:{instance.pk}:priced"
+    if etag is None:
+        etag, _ = cart_validators(instance)
+    priced = cache.get(key, version=etag)
+    if priced is None:
+        priced = compute_cart_price(instance)
+        cache.set(key, priced, settings.CART_PRICE_CACHE_TIMEOUT, version=etag)
+    return priced
@@ -0,0 +1,114 @@
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from sellers.models import Offer
+from .catalog import queue_product_refresh
+from .exceptions import OutOfStockException
+from .models import StockReservation
+
+# the stock of an offer is only ever changed by one conditional UPDATE per offer, never read and
+# written back, so two checkouts can't both take the last unit. the row lock of that UPDATE is held
+# until commit: transactions here do nothing else (no stripe calls) and lock offers in id order,
+# a hot offer sees a queue of very short locks instead of a convoy and never a deadlock. the buy box
+# and listing card refresh that follows is left to the worker, coalesced per product
+
+
+def reserve_stock(checkout, quantities):
+    """
+    take {offer id: quantity} off the offers until the checkout expires, all or nothing.
+    raises OutOfStockException with the offers that don't have enough stock left
+    """
+    missing = []
+    with transaction.atomic():
+        for offer_id in sorted(quantities):
+            # updated_at stays, it versions prices and carts and a reservation changes neither
+            taken = Offer.objects.filter(pk=offer_id, stock__gte=quantities[offer_id]).update(
+                stock=F("stock") - quantities[offer_id])
+            if not taken:
+                missing.append(offer_id)
+        if missing:
+            # nothing was reserved, the rollback gives the other offers their stock back
+            transaction.set_rollback(True)
+        else:
+            StockReservation.objects.bulk_create(
+                StockReservation(checkout=checkout, offer_id=offer_id, quantity=quantity,
+                                 expires_at=checkout.expires_at)
+                for offer_id, quantity in quantities.items()
+            )
+            stock_changed(quantities)
+    if missing:
+        raise OutOfStockException(missing)
+
+
+def stock_changed(offer_ids):
+    # buy boxes and listing cards follow the stock, queued once the change is committed
+    product_ids = set(Offer.objects.filter(pk__in=list(offer_ids)).values_list(
+        "PV__product_identity_id", flat=True))
+    transaction.on_commit(lambda: queue_product_refresh(product_ids))
+
+
+def give_back(reservations):
+    # one UPDATE per offer however many reservations it had, in id order like reserve_stock
+    totals = defaultdict(int)
+    for reservation in reservations:
+        totals[reservation.offer_id] += reservation.quantity
+    for offer_id in sorted(totals):
+        Offer.objects.filter(pk=offer_id).update(stock=F("stock") + totals[offer_id])
+    if totals:
+        stock_changed(totals)
+
+
+def release_batch(queryset, batch_size):
+    """
+    release up to batch_size held reservations of the queryset, returns how many were released.
+    rows locked by another worker are skipped, several sweepers can run side by side
+    """
+    with transaction.atomic():
+        batch = list(queryset.filter(status="held").select_for_update(skip_locked=True).order_by(
+            "id").only("id", "offer_id", "quantity")[:batch_size])
+        if not batch:
+            return 0
+        StockReservation.objects.filter(pk__in=[r.pk for r in batch]).update(status="released")
+        give_back(batch)
+    return len(batch)
+
+
+def release_checkout(checkout):
+    # the checkout was abandoned or its stripe session expired
+    while release_batch(checkout.reservations.all(), 500):
+        pass
+
+
+def release_expired(batch_size=500, now=None):
+    now = now or timezone.now()
+    released = 0
+    while True:
+        count = release_batch(StockReservation.objects.filter(expires_at__lte=now), batch_size)
+        if not count:
+            return released
+        released += count
+
+
+def consume_checkout(checkout):
+    """
+    paid, the stock is gone for good. reservations already released (the session was paid right before
+    it expired and the sweeper got there first) take their stock again, offers that don't have it anymore
+    flag the checkout oversold. returns the ids of those offers
+    """
+    oversold = []
+    with transaction.atomic():
+        # the sweeper skips locked rows, it can't release these while they are consumed
+        reservations = list(checkout.reservations.exclude(status="consumed").select_for_update().order_by("offer_id"))
+        released = [r for r in reservations if r.status == "released"]
+        for reservation in released:
+            taken = Offer.objects.filter(pk=reservation.offer_id, stock__gte=reservation.quantity).update(
+                stock=F("stock") - reservation.quantity)
+            if not taken:
+                oversold.append(reservation.offer_id)
+        StockReservation.objects.filter(pk__in=[r.pk for r in reservations]).update(status="consumed")
+        if released:
+            stock_changed(r.offer_id for r in released)
+        checkout.status = "oversold" if oversold else "paid"
+        checkout.save(update_fields=["status"])
+    return oversold
@@ -1,36 +1,130 @@
+from decimal import Decimal
 from rest_framework import serializers
-from sellers.models import Offer, ProductIdentity, ProductVariation, SellerProduct
-from .models import Cart, Checkout, CheckoutItem
+from django.conf import settings
+from django.db.models import Prefetch, F
+from django.db.models.functions import Least
+from django.utils import timezone
+from sellers.models import Offer, ProductIdentity, ProductVariation, SellerProduct, PRODUCT_TYPE_CHOICES, BRAND_CHOICES, PRODUCT_CONDITION_CHOICES
+from .cart import cart_line, upsert_cart_lines
+from .pricing import price_cart
+from .models import Cart, CartLine, Checkout, CheckoutItem, ProductListing
 from rest_framework.exceptions import ValidationError
 
 
-class ProductSerializer(serializers.ModelSerializer):
+# a listing card, read from the precomputed listing table
+class ProductListingSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source="pk", read_only=True)
     offer = serializers.SerializerMethodField()
-    default_theme = serializers.SerializerMethodField()
+    # columns each field reads, used to project the queryset with only()
+    columns = {
+        "id": ["product_identity"],
+        "default_theme": ["default_theme"],
+        "offer": ["offer", "price", "stock", "store_name"],
+        "item_name": ["item_name"],
+        "product_variations": ["product_variations"],
+        "brand_name": ["brand_name"],
+    }
 
     class Meta:
-        model = ProductIdentity
+        model = ProductListing
         fields = ["id", "default_theme", "offer",
                   "item_name", "product_variations", "brand_name",]
 
+    def __init__(self, *args, **kwargs):
+        # fields=[...] keeps only the requested fields in the output
+        fields = kwargs.pop("fields", None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def parse_fields(cls, value):
+        """
+        turn the comma separated `fields` query param into a list of field names
+        """
+        if not value:
+            return None
+        fields = [f.strip() for f in value.split(",") if f.strip()]
+        unknown = [f for f in fields if f not in cls.columns]
+        if unknown:
+            raise ValidationError(
+                {"fields": "unknown fields: {}".format(", ".join(unknown))})
+        return fields
+
+    @classmethod
+    def project(cls, queryset, fields):
+        if fields is None:
+            return queryset
+        columns = ["product_identity"]
+        for f in fields:
+            columns.extend(cls.columns[f])
+        return queryset.only(*columns)
+
     def get_offer(self, obj):
-        # default seller
-        sell = obj.sellers.get(default=True)
-        # default variations
-        var = None
-        if obj.has_variations:
-            var = obj.variations.get(default=True)
-        else:
-            var = obj.variations.first()
-        # Offer
-        offer = var.offers.get(seller=sell.seller, PV=var)
-        return {"id": offer.id, "price": offer.price, "stock": offer.stock, "store": sell.seller.store.name}
+        if obj.offer_id is None:
+            return None
+        return {"id": obj.offer_id, "price": obj.price, "stock": obj.stock, "store": obj.store_name}
+
+
+class ProductBatchSerializer(serializers.Serializer):
+    ids = serializers.CharField()
+
+    MAX_IDS = 200
+
+    def validate_ids(self, value):
+        try:
+            ids = [int(i) for i in value.split(",") if i.strip()]
+        except ValueError:
+            raise serializers.ValidationError("ids must be a comma separated list of integers.")
+        # keep the first occurrence so the response follows the request order
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            raise serializers.ValidationError("at least one id is required.")
+        if len(ids) > self.MAX_IDS:
+            raise serializers.ValidationError(
+                f"at most {self.MAX_IDS} ids can be requested at once.")
+        return ids
+
+
+class ProductFilterSerializer(serializers.Serializer):
+    product_type = serializers.ListField(
+        child=serializers.ChoiceField(choices=PRODUCT_TYPE_CHOICES), required=False)
+    brand_name = serializers.ListField(
+        child=serializers.ChoiceField(choices=BRAND_CHOICES), required=False)
+    condition = serializers.ListField(
+        child=serializers.ChoiceField(choices=PRODUCT_CONDITION_CHOICES), required=False)
+    min_price = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=Decimal("0"), required=False)
+    max_price = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=Decimal("0"), required=False)
+    in_stock = serializers.BooleanField(required=False, default=None, allow_null=True)
 
-    def get_default_theme(self, obj):
-        if obj.has_variations:
-            var = obj.variations.get(default=True)
-            return var.theme
-        return None
+    def validate(self, data):
+        if data.get("min_price") is not None and data.get("max_price") is not None:
+            if data["min_price"] > data["max_price"]:
+                raise serializers.ValidationError(
+                    "min_price cannot be greater than max_price.")
+        return data
+
+    def filter(self, queryset):
+        data = self.validated_data
+        for facet in ["product_type", "brand_name", "condition"]:
+            if data.get(facet):
+                queryset = queryset.filter(**{f"{facet}__in": data[facet]})
+        if data.get("min_price") is not None:
+            queryset = queryset.filter(price__gte=data["min_price"])
+        if data.get("max_price") is not None:
+            queryset = queryset.filter(price__lte=data["max_price"])
+        if data.get("in_stock") is True:
+            queryset = queryset.filter(stock__gt=0)
+        elif data.get("in_stock") is False:
+            queryset = queryset.filter(stock=0)
+        return queryset
+
+    @property
+    def is_filtered(self):
+        return any(v not in (None, []) for v in self.validated_data.values())
 
 
 class OfferSerializer(serializers.ModelSerializer):
@@ -43,6 +137,10 @@ class OfferSerializer(serializers.ModelSerializer):
         fields = ["id", "price", "stock", "seller", "store_name", "default"]
 
     def get_default(self, obj):
+        # ProductDetailSerializer fills this map from the prefetched sellers
+        seller_defaults = self.context.get("seller_defaults")
+        if seller_defaults is not None:
+            return seller_defaults.get(obj.seller_id, False)
         instance = obj.PV.product_identity.sellers.get(seller=obj.seller)
         return instance.default
 
@@ -52,7 +150,7 @@ class ProductVariationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ProductVariation
-        fields = ["theme", "default", "offers"]
+        fields = ["theme", "default", "buy_box", "offers"]
 
 
 class SellerProductSerializer(serializers.ModelSerializer):
@@ -74,41 +172,32 @@ class ProductDetailSerializer(serializers.ModelSerializer):
         fields = ["item_name", "product_type", "brand_name", "product_description",
                   "bullet_points", "product_details", "product_variations", "variations", "default_seller"]
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        load the whole product graph up front, the query count stays the same whatever the number of variations and offers
+        """
+        offers = Offer.objects.select_related("seller__store").order_by("id")
+        variations = ProductVariation.objects.order_by("id").prefetch_related(
+            Prefetch("offers", queryset=offers))
+        sellers = SellerProduct.objects.select_related("seller__store")
+        return queryset.prefetch_related(
+            Prefetch("variations", queryset=variations),
+            Prefetch("sellers", queryset=sellers),
+        )
+
+    def to_representation(self, instance):
+        self.context["seller_defaults"] = {
+            sp.seller_id: sp.default for sp in instance.sellers.all()}
+        return super().to_representation(instance)
+
     def get_default_seller(self, obj):
-        instance = obj.sellers.get(default=True)
+        instance = next((sp for sp in obj.sellers.all() if sp.default), None)
+        if instance is None:
+            return None
         return SellerProductSerializer(instance).data
 
 
-def update_cart_price(instance):
-    updated_items = {}
-    subtotal = 0
-    offer_ids = list(instance.keys())
-    offers = {str(o.pk): o for o in Offer.objects.filter(pk__in=offer_ids)}
-
-    # this is incorrect intance is cart instance not dictionary
-    for item_id, item_data in instance.items.items():
-        offer = offers.get(str(item_id))
-        if not offer:
-            continue
-        item_data['price'] = offer.price
-        count = item_data.get("count", 1)
-        subtotal += offer.price * count
-        updated_items[item_id] = item_data
-    return updated_items, subtotal
-
-
-def del_non_existing_offers(user):
-    instance, created = Cart.objects.get_or_create(user=user)
-    if instance.items not in [{}, None]:
-        offer_ids = list(instance.items.keys())
-        offers = {str(o.pk): o for o in Offer.objects.filter(pk__in=offer_ids)}
-        for item_id in instance.items.keys():
-            offer = offers.get(str(item_id))
-            if not offer:
-                del instance.items[str(item_id)]
-                continue
-    return instance
-
 # you delete non existing offers from cart and update the cart price
 # create a request to do that as well without necessarily adding or removing items
 # just when the user views the cart create a post request to update the cart price and delete non existing offers
@@ -116,33 +205,64 @@ def del_non_existing_offers(user):
 # post request to update the cart instance then return the updated instance
 
 
+class CartItemField(serializers.Field):
+    """
+    a bare offer id (quantity 1) or {"offer": id, "quantity": n}
+    """
+    default_error_messages = {
+        "invalid": 'expected an offer id or {{"offer": id, "quantity": n}}.',
+        "quantity": "quantity must be between 1 and {max_quantity}.",
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, dict):
+            offer, quantity = data.get("offer"), data.get("quantity", 1)
+        else:
+            offer, quantity = data, 1
+        if isinstance(offer, bool) or isinstance(quantity, bool):
+            self.fail("invalid")
+        try:
+            offer, quantity = int(offer), int(quantity)
+        except (TypeError, ValueError):
+            self.fail("invalid")
+        if not 1 <= quantity <= settings.MAX_CART_QUANTITY:
+            self.fail("quantity", max_quantity=settings.MAX_CART_QUANTITY)
+        return offer, quantity
+
+
 class AddToCartSerializer(serializers.Serializer):
     add_item = serializers.ListField(
-        child=serializers.IntegerField(), write_only=True)
+        child=CartItemField(), write_only=True, allow_empty=False, max_length=100)
     items = serializers.DictField(read_only=True)
 
     def to_representation(self, instance):
-        data = super().to_representation(instance)
-        data['items'], data['subtotal_price'] = update_cart_price(instance)
-        return data
+        # items are read from the cart lines, not from a field of the cart
+        return price_cart(instance)
+
+    def validate_add_item(self, value):
+        # the same offer twice adds up, to the cap at most
+        quantities = {}
+        for offer_id, quantity in value:
+            quantities[offer_id] = min(quantities.get(offer_id, 0) + quantity, settings.MAX_CART_QUANTITY)
+        return quantities
 
     def validate(self, data):   # storing the item details in the cart of the new items added
         user = self.context['request'].user
-        instance = del_non_existing_offers(user)
-        new_items = {}
-        items = data.pop("add_item")
-        for k in items:
-            item_data = {"count": 1}
-            offer = Offer.objects.get(pk=k)
-            item_data["product_identity"] = offer.PV.product_identity.id
-            item_data["product_variation"] = offer.PV.id
-            item_data["theme"] = offer.PV.theme
-            item_data["item_name"] = offer.PV.product_identity.item_name
-            item_data["store"] = offer.seller.store.name
-            new_items[k] = item_data
-        data["items"] = new_items
-        instance.items.update(new_items)
-        instance.save(update_fields=['items'])
+        quantities = data.pop("add_item")
+        # one query for every requested offer and what the snapshot needs
+        offers = Offer.objects.select_related("PV__product_identity", "seller__store").in_bulk(
+            list(quantities))
+        missing = [pk for pk in quantities if pk not in offers]
+        if missing:
+            raise serializers.ValidationError(
+                {"add_item": f"unknown offers: {', '.join(map(str, missing))}."})
+        if not user.is_authenticated:
+            instance = self.context["session_cart"]
+            instance.add(offers, quantities)
+        else:
+            instance, created = Cart.objects.get_or_create(user=user)
+            upsert_cart_lines([cart_line(instance, offers[pk], quantity)
+                               for pk, quantity in quantities.items()])
         self.instance = instance
         return data
 
@@ -155,9 +275,8 @@ class ViewCartSerializer(serializers.ModelSerializer):
         fields = ['items']
 
     def to_representation(self, instance):
-        data = super().to_representation(instance)
-        data['items'], data['subtotal_price'] = update_cart_price(instance)
-        return data
+        # the view passes the etag it already computed for the conditional request
+        return price_cart(instance, self.context.get("etag"))
 
 
 class CountUpdateSerializer(serializers.Serializer):
@@ -167,8 +286,6 @@ class CountUpdateSerializer(serializers.Serializer):
 
     def validate(self, data):
         user = self.context["request"].user
-        instance = Cart.objects.get(user=user)
-        items = instance.items
         increment = data.get("increment")
         decrement = data.get("decrement")
         remove = data.get("remove")
@@ -179,17 +296,30 @@ class CountUpdateSerializer(serializers.Serializer):
             raise serializers.ValidationError(
                 "You must provide exactly one of increment, decrement, or remove.")
 
-        if increment:
-            items[f"{increment}"]["count"] += 1
-        elif decrement:
-            if items[f"{decrement}"]["count"] > 1:
-                items[f"{decrement}"]["count"] -= 1
-            elif items[f"{decrement}"]["count"] == 1:
-                items.pop(f"{decrement}")
-        elif remove:
-            items.pop(f"{remove}")
-        instance.items = items
-        instance.save()
+        if not user.is_authenticated:
+            session_cart = self.context["session_cart"]
+            if increment is not None:
+                changed = session_cart.increment(increment)
+            elif decrement is not None:
+                changed = session_cart.decrement(decrement)
+            else:
+                changed = session_cart.remove(remove)
+        else:
+            # each action is one statement on one line, concurrent updates add up instead of overwriting
+            lines = CartLine.objects.filter(cart__user=user)
+            now = timezone.now()
+            if increment is not None:
+                changed = lines.filter(offer_id=increment).update(
+                    quantity=Least(F("quantity") + 1, settings.MAX_CART_QUANTITY), updated_at=now)
+            elif decrement is not None:
+                changed = lines.filter(offer_id=decrement, quantity__gt=1).update(
+                    quantity=F("quantity") - 1, updated_at=now)
+                if not changed:
+                    changed, _ = lines.filter(offer_id=decrement).delete()
+            else:
+                changed, _ = lines.filter(offer_id=remove).delete()
+        if not changed:
+            raise serializers.ValidationError("This item is not in the cart.")
         return data
 
 
@@ -206,7 +336,7 @@ class CheckoutItemSerializer(serializers.ModelSerializer):
         if obj.product_variation.theme not in [None, {}]:
             return f'{obj.product_identity.item_name} {obj.product_variation.theme}'
         return obj.product_identity.item_name
-    def get_price(self, obj):
+    def get_subtotal(self, obj):
         return obj.price * obj.quantity
 
 
@@ -0,0 +1,75 @@
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from sellers.models import ProductIdentity, ProductVariation, Offer, SellerProduct, Store
+from .catalog import refresh_listing, variation_product_id, update_search_vector, listing_facets, shift_facets, invalidate_product, invalidate_catalog, recompute_buy_box
+from .models import ProductListing
+
+
+# publish, review approval and offer changes all end up here, keep the listing cards
+# and the cached product details in sync
+
+def deleting_product(origin):
+    # nothing to refresh when the whole product is being deleted, the card goes with it
+    if isinstance(origin, QuerySet):
+        return origin.model is ProductIdentity
+    return isinstance(origin, ProductIdentity)
+
+
+@receiver(post_save, sender=ProductIdentity)
+def product_changed(sender, instance, **kwargs):
+    invalidate_product([instance.pk])
+    update_search_vector([instance.pk])
+    refresh_listing(instance.pk)
+
+
+@receiver(post_delete, sender=ProductIdentity)
+def product_deleted(sender, instance, **kwargs):
+    invalidate_product([instance.pk])
+
+
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+def variation_changed(sender, instance, **kwargs):
+    if deleting_product(kwargs.get("origin")):
+        return
+    invalidate_product([instance.product_identity_id])
+    refresh_listing(instance.product_identity_id)
+
+
+@receiver(post_save, sender=Offer)
+@receiver(post_delete, sender=Offer)
+def offer_changed(sender, instance, **kwargs):
+    if deleting_product(kwargs.get("origin")):
+        return
+    product_id = variation_product_id(instance.PV_id)
+    if product_id is None:
+        return
+    # only the variation of this offer competes again
+    recompute_buy_box([instance.PV_id])
+    invalidate_product([product_id])
+    refresh_listing(product_id)
+
+
+@receiver(post_save, sender=SellerProduct)
+@receiver(post_delete, sender=SellerProduct)
+def seller_product_changed(sender, instance, **kwargs):
+    if deleting_product(kwargs.get("origin")):
+        return
+    invalidate_product([instance.product_identity_id])
+    refresh_listing(instance.product_identity_id)
+
+
+@receiver(post_save, sender=Store)
+def store_changed(sender, instance, **kwargs):
+    invalidate_product(SellerProduct.objects.filter(
+        seller_id=instance.seller_id).values_list("product_identity_id", flat=True))
+    ProductListing.objects.filter(offer__seller_id=instance.seller_id).update(
+        store_name=instance.name)
+    invalidate_catalog()
+
+
+@receiver(post_delete, sender=ProductListing)
+def listing_deleted(sender, instance, **kwargs):
+    shift_facets(listing_facets(instance), {})
+    invalidate_catalog()
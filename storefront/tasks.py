@@ -0,0 +1,12 @@
+from sellers.models import ProductVariation
+from sellers.tasks import task
+from .catalog import REFRESH_PRODUCT_TASK, offers_changed
+
+# storefront work run by the sellers task queue worker (manage.py run_worker)
+
+
+@task(REFRESH_PRODUCT_TASK)
+def refresh_product(payload):
+    # the buy boxes and the listing card of one product after stock changes, see catalog.queue_product_refresh
+    offers_changed(ProductVariation.objects.filter(
+        product_identity_id=payload["product_id"]).values_list("id", flat=True))
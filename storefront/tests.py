@@ -1,3 +1,635 @@
-from django.test import TestCase
+import asyncio
+import threading
+import time
+import stripe
+from aiohttp import web
+from allauth.account.models import EmailAddress
+from django.core.cache import cache
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+from sellers.models import ProductIdentity, ProductVariation, Offer, Seller, SellerProduct, Store, Task
+from sellers.tasks import run_pending
+from users.models import Address, AddressPhoneNumber, Customer
+from .cart import SessionCart, cart_line, upsert_cart_lines
+from .catalog import REFRESH_PRODUCT_TASK, count_facets, product_version_key, rebuild_facets, recompute_buy_box, stored_facets
+from .exceptions import CheckoutConflictException
+from .models import Cart, CartLine, Checkout, ProductListing
+from .reservations import consume_checkout, release_checkout, release_expired, reserve_stock
+from .serializers import ProductDetailSerializer
+from .views import finish_checkout, prepare_checkout
 
-# Create your tests here.
+User = get_user_model()
+
+
+def make_seller(name):
+    user = User.objects.create(username=name, email=f"{name}@example.com")
+    seller = Seller.objects.create(user=user, seller_id=f"acct_{name}", location="US")
+    Store.objects.create(seller=seller, name=f"{name} store")
+    return seller
+
+
+def make_product(sellers, variations, upc_prefix):
+    product = ProductIdentity.objects.create(
+        item_name="Panadol", product_type="over_the_counter_drugs", brand_name="eva",
+        has_variations=variations > 1, status="approved")
+    for i, seller in enumerate(sellers):
+        SellerProduct.objects.create(
+            seller=seller, product_identity=product, default=i == 0)
+    for v in range(variations):
+        var = ProductVariation.objects.create(
+            product_identity=product, upc=f"{upc_prefix}{v:04d}",
+            theme={"pack_size": f"{v + 1} tablets"}, default=v == 0)
+        for seller in sellers:
+            Offer.objects.create(sku=f"sku-{v}", price=10 + v, stock=5, PV=var, seller=seller)
+    return product
+
+
+class ProductDetailQueryCountTests(TestCase):
+
+    def render(self, product):
+        queryset = ProductDetailSerializer.setup_eager_loading(
+            ProductIdentity.objects.filter(status="approved"))
+        return ProductDetailSerializer(queryset.get(pk=product.pk)).data
+
+    def test_query_count_does_not_grow_with_variations_and_offers(self):
+        sellers = [make_seller(f"seller{i}") for i in range(5)]
+        small = make_product(sellers[:1], 1, "1000000")
+        large = make_product(sellers, 30, "2000000")
+
+        with self.assertNumQueries(4):
+            self.render(small)
+        with self.assertNumQueries(4):
+            data = self.render(large)
+
+        self.assertEqual(len(data["variations"]), 30)
+        self.assertEqual(len(data["variations"][0]["offers"]), 5)
+        self.assertEqual(data["default_seller"]["seller"], sellers[0].pk)
+        defaults = [o["default"] for o in data["variations"][0]["offers"]]
+        self.assertEqual(defaults, [True, False, False, False, False])
+
+
+class ProductDetailCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_unchanged_product_is_not_modified(self):
+        product = make_product([make_seller("detailseller")], 1, "6000000")
+        first = self.client.get(f"/storefront/listproducts/{product.pk}/")
+        again = self.client.get(f"/storefront/listproducts/{product.pk}/", HTTP_IF_NONE_MATCH=first["ETag"])
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(again.status_code, 304)
+
+    def test_unknown_product_gets_no_version_token(self):
+        response = self.client.get("/storefront/listproducts/987654/")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(cache.get(product_version_key(987654)))
+
+
+class BuyBoxTests(TestCase):
+
+    def setUp(self):
+        sellers = [make_seller(f"boxseller{i}") for i in range(3)]
+        self.variation = make_product(sellers, 1, "7000000").variations.get()
+        self.offers = list(self.variation.offers.order_by("id"))
+
+    def update(self, offer, **fields):
+        # update() sends no signal, the recompute below is the only one
+        Offer.objects.filter(pk=offer.pk).update(**fields)
+
+    def winner(self):
+        recompute_buy_box([self.variation.pk])
+        return ProductVariation.objects.get(pk=self.variation.pk).buy_box_id
+
+    def test_offers_rank_by_stock_then_price_then_tie_breakers(self):
+        first, second, third = self.offers
+        # all the same, the oldest offer wins
+        self.assertEqual(self.winner(), first.pk)
+
+        self.update(third, price=8)
+        self.assertEqual(self.winner(), third.pk)
+        # out of stock ranks last whatever its price
+        self.update(third, stock=0)
+        self.assertEqual(self.winner(), first.pk)
+        # the discounted price is what competes
+        self.update(second, discounted_price=9)
+        self.assertEqual(self.winner(), second.pk)
+        # same price, the better condition wins, then the fulfillment channel
+        self.update(first, price=9, condition="used")
+        self.update(second, condition="used")
+        self.update(first, fullfillment_channel="FBA")
+        self.assertEqual(self.winner(), first.pk)
+        self.update(second, condition="new")
+        self.assertEqual(self.winner(), second.pk)
+
+        # nothing in stock, still the cheapest
+        Offer.objects.filter(pk__in=[offer.pk for offer in self.offers]).update(stock=0)
+        self.assertEqual(self.winner(), third.pk)
+
+
+class FacetCountTests(TestCase):
+
+    def assertFacetsMatchListings(self):
+        self.assertEqual(stored_facets(), count_facets(ProductListing.objects.all()))
+
+    def test_counters_follow_listing_changes(self):
+        seller = make_seller("facetseller")
+        cheap = make_product([seller], 1, "5000000")
+        other = make_product([seller], 2, "5100000")
+        make_product([seller], 1, "5200000")
+        self.assertFacetsMatchListings()
+
+        # moves the card to another price range, then out of stock
+        offer = Offer.objects.get(PV__product_identity=cheap)
+        offer.price = 120
+        offer.save()
+        offer.stock = 0
+        offer.save()
+        other.delete()
+
+        facets = stored_facets()
+        self.assertEqual(facets["price_range"], {"10-25": 1, "100-250": 1})
+        self.assertEqual(facets["in_stock"], {"true": 1, "false": 1})
+        self.assertFacetsMatchListings()
+
+        rebuild_facets()
+        self.assertEqual(stored_facets(), facets)
+
+
+class SessionCartMergeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        product = make_product([make_seller("mergeseller")], 2, "9000000")
+        self.first, self.second = Offer.objects.filter(PV__product_identity=product).select_related(
+            "PV__product_identity", "seller__store").order_by("id")
+        self.user = User.objects.create_user(username="merger", email="merger@example.com", password="s3cret-pass")
+        EmailAddress.objects.create(user=self.user, email=self.user.email, verified=True, primary=True)
+
+    @override_settings(MAX_CART_QUANTITY=10)
+    def test_login_merges_the_anonymous_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        upsert_cart_lines([cart_line(cart, self.first, 2), cart_line(cart, self.second, 6)])
+        added = self.client.post("/storefront/add_to_cart/", {"add_item": [
+            {"offer": self.first.pk, "quantity": 3}, {"offer": self.second.pk, "quantity": 7}]},
+            content_type="application/json")
+        self.assertEqual(added.status_code, 200)
+        request = RequestFactory().get("/")
+        request.COOKIES["cart"] = self.client.cookies["cart"].value
+        self.assertEqual(len(SessionCart(request).items), 2)
+
+        response = self.client.post("/auth/login/", {"username": self.user.email, "password": "s3cret-pass"},
+                                    content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        quantities = dict(cart.lines.values_list("offer_id", "quantity"))
+        # found in both carts the quantities add up, to the cap at most
+        self.assertEqual(quantities, {self.first.pk: 5, self.second.pk: 10})
+        # the anonymous cart is gone with its cookie
+        self.assertEqual(response.cookies["cart"].value, "")
+        self.assertEqual(SessionCart(request).items, {})
+
+    @override_settings(MAX_CART_QUANTITY=10)
+    def test_quantity_above_the_cap_is_refused(self):
+        response = self.client.post("/storefront/add_to_cart/", {"add_item": [
+            {"offer": self.first.pk, "quantity": 11}]}, content_type="application/json")
+
+        self.assertEqual(response.status_code, 400)
+
+
+class FakeStripe:
+    """
+    local stand in for api.stripe.com, every call is slowed down and its start and end are recorded
+    """
+    delay = 0.2
+
+    def __init__(self):
+        self.page_size = 100
+        self.lost_line_items = 0
+        self.failing = set()
+        self.calls = []
+        self.sessions = {}
+        self.paid = set()
+        self.by_key = {}
+        self.params_by_key = {}
+        self.idempotency_keys = []
+        self.app = web.Application()
+        self.app.router.add_post("/v1/customers/{id}", self.update_customer)
+        self.app.router.add_post("/v1/checkout/sessions", self.create_session)
+        self.app.router.add_get("/v1/checkout/sessions/{id}/line_items", self.list_line_items)
+        self.app.router.add_post("/v1/checkout/sessions/{id}/expire", self.expire_session)
+
+    def start(self):
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        async def serve():
+            self.runner = web.AppRunner(self.app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, "127.0.0.1", 0)
+            await site.start()
+            self.url = "http://127.0.0.1:{}".format(site._server.sockets[0].getsockname()[1])
+            started.set()
+
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(serve(), self.loop)
+        started.wait(5)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+    async def record(self, name):
+        start = time.monotonic()
+        await asyncio.sleep(self.delay)
+        self.calls.append((name, start, time.monotonic()))
+
+    def refused(self, name):
+        # the answer of the calls listed in failing
+        return web.json_response({"error": {
+            "type": "invalid_request_error", "message": f"{name} was refused."}}, status=400)
+
+    async def update_customer(self, request):
+        await self.record("update_customer")
+        if "update_customer" in self.failing:
+            return self.refused("update_customer")
+        return web.json_response({"id": request.match_info["id"], "object": "customer"})
+
+    async def create_session(self, request):
+        form = await request.post()
+        await self.record("create_session")
+        if "create_session" in self.failing:
+            return self.refused("create_session")
+        key = request.headers.get("Idempotency-Key")
+        self.idempotency_keys.append(key)
+        if key in self.by_key:
+            # like stripe, a key is only replayed for the same parameters
+            if self.params_by_key[key] != dict(form):
+                return web.json_response({"error": {
+                    "type": "idempotency_error", "message": "Keys for idempotent requests can only be used "
+                    "with the same parameters they were first used with."}}, status=400)
+            return web.json_response(self.by_key[key])
+        self.params_by_key[key] = dict(form)
+        session_id = f"cs_test_{len(self.sessions)}"
+        count = len([key for key in form if key.startswith("line_items[") and key.endswith("[quantity]")])
+        quantities = [int(form[f"line_items[{i}][quantity]"]) for i in range(count)]
+        self.sessions[session_id] = quantities
+        self.by_key[key] = {
+            "id": session_id, "object": "checkout.session", "status": "open",
+            "client_secret": f"{session_id}_secret", "amount_subtotal": 1000 * sum(quantities),
+        }
+        return web.json_response(self.by_key[key])
+
+    async def list_line_items(self, request):
+        await self.record("list_line_items")
+        quantities = self.sessions[request.match_info["id"]]
+        items = [{"id": f"li_{i}", "object": "item", "quantity": q} for i, q in enumerate(quantities)]
+        items = items[:len(items) - self.lost_line_items]
+        start = int(request.query.get("starting_after", "li_-1").split("_")[1]) + 1
+        end = start + min(int(request.query.get("limit", 10)), self.page_size)
+        return web.json_response({
+            "object": "list", "has_more": end < len(items), "url": request.path, "data": items[start:end],
+        })
+
+    async def expire_session(self, request):
+        await self.record("expire_session")
+        if request.match_info["id"] in self.paid:
+            return web.json_response({"error": {
+                "type": "invalid_request_error", "message": "Only Checkout Sessions with a status of open can be expired."
+            }}, status=400)
+        return web.json_response({"id": request.match_info["id"], "object": "checkout.session", "status": "expired"})
+
+
+class AsyncCheckoutTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stripe = FakeStripe()
+        cls.stripe.start()
+        cls.settings = override_settings(STRIPE_API_BASE=cls.stripe.url)
+        cls.settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings.disable()
+        cls.stripe.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.stripe.calls.clear()
+        self.stripe.idempotency_keys.clear()
+        self.stripe.paid.clear()
+        self.stripe.page_size = 100
+        self.stripe.lost_line_items = 0
+        self.stripe.failing.clear()
+        self.user = User.objects.create(username="shopper", email="shopper@example.com")
+        Customer.objects.create(user=self.user, customer_id="cus_test")
+        phone = AddressPhoneNumber.objects.create(user=self.user, phone_number="+12025550123")
+        Address.objects.create(
+            user=self.user, default=True, country="US", city="Austin", state="TX",
+            street_address="1 main st", postal_code="73301", phone_number=phone)
+        product = make_product([make_seller("checkoutseller")], 2, "3000000")
+        self.offers = list(Offer.objects.filter(PV__product_identity=product).select_related(
+            "PV__product_identity", "seller__store").order_by("id"))
+        self.client.force_login(self.user)
+
+    def fill_cart(self, quantity):
+        cart = Cart.objects.create(user=self.user)
+        upsert_cart_lines([cart_line(cart, offer, quantity) for offer in self.offers])
+
+    def test_checkout_runs_independent_stripe_calls_concurrently(self):
+        self.fill_cart(2)
+        response = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["clientSecret"].endswith("_secret"))
+        calls = {name: (start, end) for name, start, end in self.stripe.calls}
+        # the customer update and the session creation overlap, the line items wait for the session
+        self.assertLess(calls["update_customer"][0], calls["create_session"][1])
+        self.assertLess(calls["create_session"][0], calls["update_customer"][1])
+        self.assertGreaterEqual(calls["list_line_items"][0], calls["create_session"][1])
+
+        checkout = Checkout.objects.get(user=self.user)
+        self.assertEqual(sorted(checkout.items.values_list("line_item_id", flat=True)), ["li_0", "li_1"])
+        for offer in self.offers:
+            offer.refresh_from_db()
+            self.assertEqual(offer.stock, 3)
+
+    def test_line_items_are_read_from_every_page(self):
+        self.stripe.page_size = 1
+        self.fill_cart(1)
+        response = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([name for name, _, _ in self.stripe.calls].count("list_line_items"), 2)
+        checkout = Checkout.objects.get(user=self.user)
+        self.assertEqual(dict(checkout.items.values_list("offer_id", "line_item_id")), {
+            self.offers[0].pk: "li_0", self.offers[1].pk: "li_1"})
+
+    def test_missing_line_items_store_no_checkout(self):
+        self.stripe.lost_line_items = 1
+        self.fill_cart(1)
+        response = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(response.status_code, 502)
+        self.assertFalse(Checkout.objects.filter(user=self.user).exists())
+        self.assertIn("expire_session", [name for name, _, _ in self.stripe.calls])
+        self.assertEqual(Offer.objects.get(pk=self.offers[0].pk).stock, 5)
+
+    def open_checkout_then_change_cart(self):
+        self.fill_cart(1)
+        first = self.client.post("/storefront/checkout/")
+        Cart.objects.get(user=self.user).lines.filter(offer=self.offers[0]).delete()
+        self.stripe.calls.clear()
+        return Checkout.objects.get(client_secret=first.json()["clientSecret"])
+
+    def assertStillOpen(self, checkout):
+        checkout.refresh_from_db()
+        self.assertEqual(checkout.status, "pending")
+        self.assertEqual(checkout.reservations.filter(status="held").count(), 2)
+        self.assertEqual(Offer.objects.get(pk=self.offers[0].pk).stock, 4)
+
+    def test_failed_customer_update_expires_the_new_session_only(self):
+        old = self.open_checkout_then_change_cart()
+        self.stripe.failing.add("update_customer")
+        with self.assertLogs("storefront.views", "WARNING"):
+            response = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(Checkout.objects.filter(user=self.user).count(), 1)
+        # the session created meanwhile can't be paid, the old one is kept
+        calls = [name for name, _, _ in self.stripe.calls]
+        self.assertEqual((calls.count("create_session"), calls.count("expire_session")), (1, 1))
+        self.assertStillOpen(old)
+
+    def test_failed_session_creation_keeps_the_open_checkout(self):
+        old = self.open_checkout_then_change_cart()
+        self.stripe.failing.add("create_session")
+        with self.assertLogs("storefront.views", "WARNING"):
+            response = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(response.status_code, 502)
+        self.assertNotIn("expire_session", [name for name, _, _ in self.stripe.calls])
+        self.assertStillOpen(old)
+
+    def test_out_of_stock_expires_the_session(self):
+        self.fill_cart(6)
+        response = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("expire_session", [name for name, _, _ in self.stripe.calls])
+        self.assertEqual(Checkout.objects.get(user=self.user).status, "abandoned")
+        self.assertEqual(Offer.objects.get(pk=self.offers[0].pk).stock, 5)
+
+    def test_unchanged_cart_reuses_the_open_session(self):
+        self.fill_cart(1)
+        first = self.client.post("/storefront/checkout/")
+        again = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.json()["clientSecret"], first.json()["clientSecret"])
+        self.assertEqual([name for name, _, _ in self.stripe.calls].count("create_session"), 1)
+        self.assertEqual(Checkout.objects.filter(user=self.user).count(), 1)
+
+        # a changed cart gets a new session and the open one is abandoned
+        Cart.objects.get(user=self.user).lines.filter(offer=self.offers[0]).delete()
+        changed = self.client.post("/storefront/checkout/")
+        self.assertNotEqual(changed.json()["clientSecret"], first.json()["clientSecret"])
+        self.assertIn("expire_session", [name for name, _, _ in self.stripe.calls])
+        self.assertEqual(Checkout.objects.get(client_secret=first.json()["clientSecret"]).status, "abandoned")
+        self.assertEqual(Offer.objects.get(pk=self.offers[0].pk).stock, 5)
+
+    def test_superseded_session_that_was_paid_keeps_its_stock(self):
+        self.fill_cart(1)
+        first = self.client.post("/storefront/checkout/")
+        old = Checkout.objects.get(client_secret=first.json()["clientSecret"])
+        # paid on stripe, the webhook hasn't arrived yet
+        self.stripe.paid.add(old.payment_session_id)
+
+        Cart.objects.get(user=self.user).lines.filter(offer=self.offers[0]).delete()
+        with self.assertLogs("storefront.views", "WARNING"):
+            changed = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(changed.status_code, 200)
+        old.refresh_from_db()
+        self.assertEqual(old.status, "pending")
+        self.assertEqual(old.reservations.filter(status="held").count(), 2)
+        self.assertEqual(Offer.objects.get(pk=self.offers[0].pk).stock, 4)
+
+    def test_retry_after_out_of_stock_gets_a_new_session(self):
+        self.fill_cart(6)
+        failed = self.client.post("/storefront/checkout/")
+        self.assertEqual(failed.status_code, 409)
+
+        Offer.objects.filter(pk__in=[offer.pk for offer in self.offers]).update(stock=10)
+        retry = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(len(set(self.stripe.idempotency_keys)), 2)
+        checkout = Checkout.objects.get(client_secret=retry.json()["clientSecret"])
+        self.assertEqual(checkout.status, "pending")
+        self.assertEqual(checkout.reservations.filter(status="held").count(), 2)
+        self.assertEqual(Offer.objects.get(pk=self.offers[0].pk).stock, 4)
+
+    def test_replayed_session_of_a_closed_checkout_is_a_conflict(self):
+        self.fill_cart(1)
+        first = self.client.post("/storefront/checkout/")
+        old = Checkout.objects.get(client_secret=first.json()["clientSecret"])
+        Checkout.objects.filter(pk=old.pk).update(status="abandoned")
+        session = stripe.checkout.Session.construct_from({
+            "id": old.payment_session_id, "client_secret": old.client_secret, "amount_subtotal": 2000}, "sk_test")
+        checkout = prepare_checkout(self.user)
+
+        with self.assertRaises(CheckoutConflictException):
+            finish_checkout(self.user, session, [{"id": "li_0"}, {"id": "li_1"}], checkout)
+
+    def test_retry_after_a_failed_attempt_gets_a_new_session(self):
+        self.fill_cart(1)
+        self.stripe.failing.add("update_customer")
+        with self.assertLogs("storefront.views", "WARNING"):
+            failed = self.client.post("/storefront/checkout/")
+        self.assertEqual(failed.status_code, 502)
+        self.assertFalse(Checkout.objects.filter(user=self.user).exists())
+
+        # a second later, stripe already holds the first session under the first key
+        time.sleep(1)
+        self.stripe.failing.clear()
+        retry = self.client.post("/storefront/checkout/")
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(len(set(self.stripe.idempotency_keys)), 2)
+        self.assertEqual(Checkout.objects.get(user=self.user).client_secret, retry.json()["clientSecret"])
+
+    def test_same_attempt_sends_the_same_parameters(self):
+        self.fill_cart(1)
+        first = prepare_checkout(self.user)
+        time.sleep(1)
+        again = prepare_checkout(self.user)
+
+        self.assertEqual(again["stripe_idempotency_key"], first["stripe_idempotency_key"])
+        self.assertEqual(again["session_params"], first["session_params"])
+
+    def test_idempotency_key_is_forwarded_to_stripe(self):
+        self.fill_cart(1)
+        first = self.client.post("/storefront/checkout/", HTTP_IDEMPOTENCY_KEY="order-1")
+        again = self.client.post("/storefront/checkout/", HTTP_IDEMPOTENCY_KEY="order-1")
+
+        self.assertEqual(again.json()["clientSecret"], first.json()["clientSecret"])
+        self.assertEqual(len(self.stripe.idempotency_keys), 1)
+        self.assertTrue(self.stripe.idempotency_keys[0].startswith(f"checkout-{self.user.pk}-"))
+        self.assertEqual(Checkout.objects.get(user=self.user).idempotency_key, "order-1")
+
+
+class ConsumeCheckoutTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="payer", email="payer@example.com")
+        product = make_product([make_seller("consumeseller")], 1, "4000000")
+        self.offer = Offer.objects.get(PV__product_identity=product)
+        self.checkout = Checkout.objects.create(
+            user=self.user, subtotal=20, payment_session_id="cs_paid",
+            expires_at=timezone.now(), soft_expires_at=timezone.now())
+        reserve_stock(self.checkout, {self.offer.pk: 2})
+
+    def test_paid_checkout_consumes_its_reservations(self):
+        self.assertEqual(consume_checkout(self.checkout), [])
+        self.assertEqual(self.checkout.status, "paid")
+        self.assertEqual(self.checkout.reservations.get().status, "consumed")
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).stock, 3)
+
+    def test_released_reservation_takes_its_stock_again(self):
+        # the sweeper ran before the payment webhook arrived
+        release_expired()
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).stock, 5)
+
+        self.assertEqual(consume_checkout(self.checkout), [])
+        self.assertEqual(self.checkout.status, "paid")
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).stock, 3)
+
+    def test_released_stock_sold_meanwhile_flags_the_checkout(self):
+        release_expired()
+        Offer.objects.filter(pk=self.offer.pk).update(stock=1)
+
+        self.assertEqual(consume_checkout(self.checkout), [self.offer.pk])
+        self.assertEqual(Checkout.objects.get(pk=self.checkout.pk).status, "oversold")
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).stock, 1)
+
+
+class StockRefreshQueueTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username="hotsku", email="hotsku@example.com")
+        self.product = make_product([make_seller("hotskuseller")], 1, "9100000")
+        self.offer = Offer.objects.get(PV__product_identity=self.product)
+        self.checkouts = [Checkout.objects.create(
+            user=user, subtotal=10, payment_session_id=f"cs_hot_{i}",
+            expires_at=timezone.now(), soft_expires_at=timezone.now()) for i in range(2)]
+
+    def listed_stock(self):
+        return ProductListing.objects.get(pk=self.product.pk).stock
+
+    def test_stock_changes_queue_one_refresh_per_product(self):
+        for checkout in self.checkouts:
+            with self.captureOnCommitCallbacks(execute=True):
+                reserve_stock(checkout, {self.offer.pk: 2})
+
+        tasks = Task.objects.filter(name=REFRESH_PRODUCT_TASK)
+        self.assertEqual(list(tasks.values_list("payload", flat=True)), [{"product_id": self.product.pk}])
+        # the checkouts never touched the listing card
+        self.assertEqual(self.listed_stock(), 5)
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(self.listed_stock(), 1)
+
+        # the task ran, the next change needs a new one
+        with self.captureOnCommitCallbacks(execute=True):
+            release_checkout(self.checkouts[0])
+        self.assertEqual(tasks.filter(status="queued").count(), 1)
+        run_pending()
+        self.assertEqual(self.listed_stock(), 3)
+
+
+class CartLinesMigrationTests(TransactionTestCase):
+    migrate_from = [("storefront", "0004_cart_updated_at")]
+    migrate_to = [("storefront", "0005_cartline")]
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.migrate_from)
+        self.old_apps = self.executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_cart_items_become_cart_lines(self):
+        user = User.objects.create(username="oldcart", email="oldcart@example.com")
+        product = make_product([make_seller("oldcartseller")], 2, "8000000")
+        first, second = Offer.objects.filter(PV__product_identity=product).order_by("id")
+        OldCart = self.old_apps.get_model("storefront", "Cart")
+        cart = OldCart.objects.create(user_id=user.pk, items={
+            str(first.pk): {"count": 3, "item_name": "stale name", "store": "stale store"},
+            str(second.pk): {"count": 0},
+            # an offer deleted since it was added
+            "999999": {"count": 1},
+        })
+
+        self.executor.loader.build_graph()
+        self.executor.migrate(self.migrate_to)
+
+        lines = {line.offer_id: line for line in CartLine.objects.filter(cart_id=cart.pk)}
+        self.assertEqual(set(lines), {first.pk, second.pk})
+        self.assertEqual((lines[first.pk].quantity, lines[second.pk].quantity), (3, 1))
+        # the snapshot is taken from the offer, not from what the old cart held
+        self.assertEqual(lines[first.pk].item_name, "Panadol")
+        self.assertEqual(lines[first.pk].store, "oldcartseller store")
+        self.assertEqual(lines[first.pk].product_variation_id, first.PV_id)
+        self.assertEqual(lines[first.pk].theme, {"pack_size": "1 tablets"})
@@ -4,6 +4,9 @@ from . import views
 urlpatterns = [
     path("listproducts/",views.ProductGetListView.as_view()),
     path("listproducts/<int:pk>/",views.ProductGetListView.as_view()),
+    path("listproducts/batch/",views.ProductBatchView.as_view()),
+    path("search/",views.ProductSearchView.as_view()),
+    path("filter/",views.ProductFilterView.as_view()),
     path("add_to_cart/",views.AddToCartView.as_view()),
     path("cart/",views.AddToCartView.as_view()),
     path("checkout/",views.CheckoutView.as_view()),
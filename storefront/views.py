@@ -1,65 +1,75 @@
 from rest_framework import generics
-from rest_framework.views import APIView
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
 from rest_framework.response import Response
 from rest_framework import status, exceptions
-from sellers.models import ProductIdentity, Offer
-from .serializers import AddToCartSerializer, ProductSerializer, ProductDetailSerializer, ViewCartSerializer, CountUpdateSerializer, CheckoutSerializer, update_cart_price
+from sellers.models import ProductIdentity
+from .serializers import AddToCartSerializer, ProductListingSerializer, ProductBatchSerializer, ProductFilterSerializer, ProductDetailSerializer, ViewCartSerializer, CountUpdateSerializer, CheckoutSerializer
 from rest_framework import permissions
-from .models import Cart, Checkout, CheckoutItem
+from .models import Cart, CartLine, Checkout, CheckoutItem, ProductListing
+from .cart import SessionCart
+from .pricing import cart_validators
+from .reservations import reserve_stock, release_checkout
+from .exceptions import CheckoutConflictException, OutOfStockException, PaymentProviderException
+from .pagination import ProductCursorPagination, SearchPagination
+from .catalog import SEARCH_CONFIG, count_facets, stored_facets, get_cached_product_detail, cache_product_detail, product_version, catalog_version, version_time
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, Prefetch
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from hashlib import md5
 from datetime import timedelta
 from django.utils import timezone
+from django.db import transaction, IntegrityError
+import asyncio
+import logging
+import uuid
 import stripe
 import datetime
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.decorators import method_decorator
 from django.conf import settings
+from django.core.cache import cache
 
-
-def del_non_existing_offers(instance):
-    offer_ids = list(instance.items.keys())
-    offers = {str(o.pk): o for o in Offer.objects.filter(pk__in=offer_ids)}
-    for item_id in instance.items.keys():
-        offer = offers.get(str(item_id))
-        if not offer:
-            del instance.items[str(item_id)]
-            continue
-    instance.save(update_fields=['items'])
-    return instance
+logger = logging.getLogger(__name__)
 
 
 def get_line_items(user):
     line_items = []
     checkout_items = []
-    cart = del_non_existing_offers(user.cart)  # cart instane
-    offer_ids = list(cart.keys())
-    offers = {str(o.pk): o for o in Offer.objects.filter(pk__in=offer_ids)}
-    cart_items = cart.items
-    for item_id, item_data in cart_items.items():
-        offer = offers.get(str(item_id))
+    # lines of deleted offers are already gone with the offer
+    lines = CartLine.objects.filter(cart__user=user).select_related(
+        "offer__seller__store", "offer__PV__product_identity").order_by("id")
+    for line in lines:
+        offer = line.offer
         checkout_items.append(
-            {"product_identity": item_data["product_identity"],
-             "product_variation": item_data["product_variation"],
+            {"product_identity": line.product_identity_id,
+             "product_variation": line.product_variation_id,
              "offer": offer.id,
              "store": offer.seller.store.id,
-             "name": item_data["theme"],
+             "name": line.theme,
              "price": offer.price,
-             "quantity": item_data["count"],
+             "quantity": line.quantity,
              "discounted_price": offer.discounted_price,
              }
         )
         line_items.append({"price_data": {
             "currency": "usd",
-            "prodcuct": offer.PV.product_identity.stripe_product_id,
+            "product": offer.PV.product_identity.sripe_product_id,
             "tax_behavior": "exclusive",
             "unit_amount_decimal": offer.price,
         },
-            "quantity": item_data["count"],
-            "meta_data": {"offer_id": offer.id}
+            "quantity": line.quantity,
         },
         )
+    # stripe returns the line items in this same order, see create_checkout_instance
     return line_items, checkout_items
 
 
 def get_shipping_cost(user):
-    address = user.addresses.get(default=True)
     # calculate cost based on address (dynamic shipping cost)
     # logic here
     # in the mean time we will have fixed delivery cost
@@ -79,29 +89,24 @@ def get_shipping_cost(user):
                 'tax_behavior': 'exclusive',
             },
         },
-    ],
+    ]
     shipping_address_collection = {
         'allowed_countries': ['US'],
-    },
+    }
     return shipping_options, shipping_address_collection
 
 
-def update_customer_address(user):
-    default_address = user.addresses.get(default=True)
-    customer = stripe.Customer.modify(
-        user.customer.customer_id,
-        address={
-            # Required for calculating tax
-            "country": default_address["country"],
-            "state": default_address["state"],
-            "city": default_address["city"],
-            "line1": default_address["street_address"],
-            "line2": f'{default_address["building_address"]}, {default_address["apartment_address"]}',
-            # Required for calculating tax
-            "postal_code": default_address["postal_code"]
-        }
-
-    )
+def customer_address(address):
+    return {
+        # Required for calculating tax
+        "country": str(address.country),
+        "state": address.state,
+        "city": address.city,
+        "line1": address.street_address,
+        "line2": f'{address.building_address}, {address.apartment_address}',
+        # Required for calculating tax
+        "postal_code": address.postal_code,
+    }
 
 
 def get_timestamp(minutes):
@@ -110,117 +115,454 @@ def get_timestamp(minutes):
     return time_now_utc + duration
 
 
-def create_checkout_instance(user, session, line_items, checkout_items):
+def find_open_checkout(user, cart_version, idempotency_key):
+    # a retry with the same key gets the same checkout, otherwise an unchanged cart reuses its open session
+    pending = Checkout.objects.filter(user=user, status="pending", expires_at__gt=timezone.now())
+    if idempotency_key:
+        checkout_instance = pending.filter(idempotency_key=idempotency_key).first()
+        if checkout_instance is not None:
+            return checkout_instance
+    return pending.filter(cart_version=cart_version).order_by("-created_at").first()
+
+
+def checkout_attempt(user, cart_version, idempotency_key):
+    """
+    the stripe idempotency key of this checkout attempt and the expires_at first sent with it. double
+    submits and retries send the same parameters under the same key, stripe answers with the session it
+    already created instead of refusing other parameters. the view ends the attempt once it is over
+    (stored or failed), the next one gets its own key and a fresh expires_at
+    """
+    key = f"checkout:attempt:{user.pk}:{md5(f'{cart_version}:{idempotency_key}'.encode()).hexdigest()}"
+    new = {"key": uuid.uuid4().hex, "expires_at": int(get_timestamp(settings.CHECKOUT_EXPIRATION).timestamp())}
+    # concurrent requests all get the attempt of the first one
+    cache.add(key, new, settings.CHECKOUT_EXPIRATION * 60)
+    return {"cache_key": key, **(cache.get(key) or new)}
+
+
+def prepare_checkout(user, idempotency_key=""):
+    """
+    everything a checkout needs from the database before stripe is called,
+    or the response of the open checkout that already covers this cart
+    """
+    if len(idempotency_key) > 255:
+        raise exceptions.ValidationError({"detail": "Idempotency-Key is too long."})
+    cart = Cart.objects.filter(user=user).first()
+    if cart is None:
+        raise exceptions.ValidationError({"detail": "Cart is empty."})
+    cart_version, _ = cart_validators(cart)
+    existing = find_open_checkout(user, cart_version, idempotency_key)
+    if existing is not None:
+        return {"response": checkout_response(existing)}
+
+    # replaced by the new checkout, their stock goes back once their sessions can't be paid anymore
+    superseded = list(Checkout.objects.filter(user=user, status="pending"))
+
+    address = user.addresses.filter(default=True).first()
+    if address is None:
+        raise exceptions.ValidationError({"detail": "A default address is required."})
+    line_items, checkout_items = get_line_items(user)
+    if not checkout_items:
+        raise exceptions.ValidationError({"detail": "Cart is empty."})
+    shipping_options, shipping_address_collection = get_shipping_cost(user)
+    session_params = {
+        "automatic_tax": {"enabled": True},
+        "customer": user.customer.customer_id,
+        "line_items": line_items,
+        "mode": "payment",
+        "ui_mode": "embedded",
+        "return_url": "https://example.com/return",
+        "saved_payment_method_options": {"payment_method_save": "enabled"},
+        "shipping_options": shipping_options,
+        "shipping_address_collection": shipping_address_collection,
+        "allow_promotion_codes": True,
+    }
+    attempt = checkout_attempt(user, cart_version, idempotency_key)
+    session_params["expires_at"] = attempt["expires_at"]
+    return {
+        "customer_id": user.customer.customer_id,
+        "address": customer_address(address),
+        "session_params": session_params,
+        "checkout_items": checkout_items,
+        "cart_version": cart_version,
+        "idempotency_key": idempotency_key,
+        "stripe_idempotency_key": f"checkout-{user.pk}-{attempt['key']}",
+        "attempt": attempt["cache_key"],
+        "superseded": superseded,
+    }
+
+
+def create_checkout_instance(user, session, line_items, checkout_items, cart_version="", idempotency_key=""):
+    # items are paired with the stripe line items by position, a missing one would never be found by the webhook
+    if len(line_items) != len(checkout_items):
+        raise PaymentProviderException()
     now = timezone.now()
-    checkout_instance = Checkout.objects.create(
-        user=user,
-        subtotal=session["amount_subtotal"],
-        expires_at=now + timedelta(minutes=settings.checkout_expiration),
-        soft_expires_at=now + timedelta(days=1),
-        payment_session_id=session.id
-    )
-    for checkout_item in checkout_items:
-        CheckoutItem.objects.create(
-            checkout=checkout_instance,
-            product_identity=checkout_item["product_identity"],
-            product_variation=checkout_item["product_variation"],
-            offer=checkout_item["offer"],
-            store=checkout_item["store"],
-            name=checkout_item["name"],
-            price=checkout_item["price"],
-            discounted_price=checkout_item["discounted_price"],
+    # a fixed number of queries whatever the size of the cart
+    with transaction.atomic():
+        checkout_instance = Checkout.objects.create(
+            user=user,
+            subtotal=session["amount_subtotal"],
+            expires_at=now + timedelta(minutes=settings.CHECKOUT_EXPIRATION),
+            soft_expires_at=now + timedelta(days=1),
+            payment_session_id=session.id,
+            client_secret=session.client_secret,
+            cart_version=cart_version,
+            idempotency_key=idempotency_key,
+        )
+        items = CheckoutItem.objects.bulk_create(
+            CheckoutItem(
+                checkout=checkout_instance,
+                product_identity_id=checkout_item["product_identity"],
+                product_variation_id=checkout_item["product_variation"],
+                offer_id=checkout_item["offer"],
+                store_id=checkout_item["store"],
+                name=checkout_item["name"],
+                price=checkout_item["price"],
+                quantity=checkout_item["quantity"],
+                discounted_price=checkout_item["discounted_price"],
+            )
+            for checkout_item in checkout_items
         )
-    items = checkout_instance.items.all()
-    # this need to be refactored, it's very bad performance wise
-    for item in line_items:
-        instance = items.get(offer=item["meta_data"]["offer_id"])
-        instance.line_item_id = item["data"]["id"]
-        instance.save()
+        # the stripe line items come back in the order they were sent
+        by_offer = {item.offer_id: item for item in items}
+        for checkout_item, line_item in zip(checkout_items, line_items):
+            by_offer[checkout_item["offer"]].line_item_id = line_item["id"]
+        CheckoutItem.objects.bulk_update(items, ["line_item_id"])
 # whatever has # sign will be assigned after the checkout session is completed
 
     return checkout_instance
 
 
+def checkout_response(checkout_instance):
+    # would you return the checkout instance
+    # if yes then you need serializer for checkout instance with checkout items
+    checkout_instance = Checkout.objects.prefetch_related(Prefetch(
+        "items", queryset=CheckoutItem.objects.select_related("product_identity", "product_variation"))
+    ).get(pk=checkout_instance.pk)
+    return {"clientSecret": checkout_instance.client_secret, "Checkout": CheckoutSerializer(checkout_instance).data}
+
+
+def finish_checkout(user, session, line_items, checkout):
+    """
+    store the checkout and reserve its stock, the caller expires the session when this raises
+    """
+    try:
+        checkout_instance = create_checkout_instance(
+            user, session, line_items, checkout["checkout_items"], checkout["cart_version"], checkout["idempotency_key"])
+    except IntegrityError:
+        # a concurrent double submit got the same session from stripe and stored it first,
+        # anything else than an open checkout holding its stock can't be handed out
+        existing = Checkout.objects.get(payment_session_id=session.id)
+        if existing.status != "pending" or existing.expires_at <= timezone.now():
+            raise CheckoutConflictException()
+        return checkout_response(existing)
+    try:
+        reserve_stock(checkout_instance, {
+            item["offer"]: item["quantity"] for item in checkout["checkout_items"]})
+    except OutOfStockException:
+        checkout_instance.status = "abandoned"
+        checkout_instance.save(update_fields=["status"])
+        raise
+    return checkout_response(checkout_instance)
+
+
+def abandon_checkout(checkout_instance):
+    # only while pending, a webhook may have settled it meanwhile
+    if Checkout.objects.filter(pk=checkout_instance.pk, status="pending").update(status="abandoned"):
+        release_checkout(checkout_instance)
+
+
+async def list_line_items(client, session_id):
+    # every page, a cart has no line limit
+    page = await client.checkout.sessions.line_items.list_async(session_id, params={"limit": 100})
+    return [line_item async for line_item in page.auto_paging_iter()]
+
+
+async def expire_session(client, session_id):
+    # best effort, a session that can't be expired anymore was paid or expired already
+    try:
+        await client.checkout.sessions.expire_async(session_id)
+    except stripe.StripeError:
+        logger.warning("could not expire checkout session %s", session_id, exc_info=True)
+        return False
+    return True
+
+
+async def supersede_checkouts(client, checkouts):
+    """
+    expire the stripe sessions of the checkouts a new one replaces and only then give their stock back,
+    a session that can't be expired (paid, or stripe unreachable) is left to its webhook and expiry
+    """
+    for checkout_instance in checkouts:
+        if await expire_session(client, checkout_instance.payment_session_id):
+            await sync_to_async(abandon_checkout)(checkout_instance)
+
+
+async def open_checkout(client, user, checkout):
+    """
+    the stripe side of a checkout. the new session is stored with its stock reserved before the sessions
+    it replaces are expired, a failure on the way leaves the open checkout of the user as it was and
+    expires the new session so it can't be paid
+    """
+    # tax is computed on the shipping address the session collects,
+    # the customer address update doesn't have to land first
+    customer, session = await asyncio.gather(
+        client.customers.update_async(
+            checkout["customer_id"], params={"address": checkout["address"]}),
+        client.checkout.sessions.create_async(
+            params=checkout["session_params"],
+            options={"idempotency_key": checkout["stripe_idempotency_key"]}),
+        return_exceptions=True,
+    )
+    if isinstance(session, BaseException):
+        raise session
+    try:
+        if isinstance(customer, BaseException):
+            raise customer
+        line_items = await list_line_items(client, session.id)
+        data = await sync_to_async(finish_checkout)(user, session, line_items, checkout)
+    except BaseException:
+        # nothing is reserved for it
+        await expire_session(client, session.id)
+        raise
+    await supersede_checkouts(client, [
+        checkout_instance for checkout_instance in checkout["superseded"]
+        if checkout_instance.payment_session_id != session.id])
+    return data
+
+
+def get_stripe_client(http_client):
+    # with an aiohttp client the *_async calls don't block the event loop.
+    # STRIPE_API_BASE points it somewhere else than api.stripe.com (the fake stripe of the tests)
+    base_addresses = {"api": settings.STRIPE_API_BASE} if settings.STRIPE_API_BASE else {}
+    return stripe.StripeClient(
+        settings.STRIPE_TEST_SECRET_KEY, http_client=http_client, base_addresses=base_addresses)
+
+
+def authenticate(request):
+    # the rest framework authentication (session or jwt cookie, csrf included) outside of an APIView
+    drf_request = Request(request, authenticators=[
+        auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    if not drf_request.user.is_authenticated:
+        raise exceptions.NotAuthenticated()
+    return drf_request.user
+
+
+def conditional_get(request, etag, last_modified):
+    """
+    answer with 304 when the client copy is still fresh, without rendering anything
+    """
+    return get_conditional_response(
+        request, etag=quote_etag(etag), last_modified=int(last_modified.timestamp()))
+
+
+def set_validators(response, etag, last_modified):
+    response["ETag"] = quote_etag(etag)
+    response["Last-Modified"] = http_date(last_modified.timestamp())
+    return response
+
+
 class ProductGetListView(generics.GenericAPIView):
     authentication_classes = []
     permission_classes = []
+    pagination_class = ProductCursorPagination
 
     def get(self, request, **kwargs):
         if kwargs.get("pk"):
-            product = ProductIdentity.objects.get(
-                status="approved", id=kwargs["pk"])
-            serializer = ProductDetailSerializer(product)
-            return Response(serializer.data)
+            # the version token lives in the cache, checking it costs no query.
+            # only an approved product gets one, made up ids must not fill the cache
+            version = product_version(kwargs["pk"], create=False)
+            if version is None:
+                if not ProductIdentity.objects.filter(pk=kwargs["pk"], status="approved").exists():
+                    raise exceptions.NotFound()
+                version = product_version(kwargs["pk"])
+            etag, last_modified = f"product-{kwargs['pk']}-{version}", version_time(version)
+            not_modified = conditional_get(request, etag, last_modified)
+            if not_modified is not None:
+                return not_modified
+            data = get_cached_product_detail(kwargs["pk"])
+            if data is None:
+                products = ProductDetailSerializer.setup_eager_loading(
+                    ProductIdentity.objects.filter(status="approved"))
+                product = generics.get_object_or_404(products, id=kwargs["pk"])
+                data = ProductDetailSerializer(product).data
+                cache_product_detail(kwargs["pk"], data)
+            return set_validators(Response(data), etag, last_modified)
+        else:
+            # the page depends on the query string (cursor, page size, fields) and on the catalog version
+            version = catalog_version()
+            etag = f"catalog-{version}-{md5(request.get_full_path().encode()).hexdigest()}"
+            last_modified = version_time(version)
+            not_modified = conditional_get(request, etag, last_modified)
+            if not_modified is not None:
+                return not_modified
+            # listing cards are precomputed, one query for the whole page
+            fields = ProductListingSerializer.parse_fields(
+                request.query_params.get("fields"))
+            products = ProductListingSerializer.project(
+                ProductListing.objects.all(), fields)
+            page = self.paginate_queryset(products)
+            serializer = ProductListingSerializer(page, many=True, fields=fields)
+            return set_validators(self.get_paginated_response(serializer.data), etag, last_modified)
+
+
+class ProductBatchView(generics.GenericAPIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, request):
+        serializer = ProductBatchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data["ids"]
+        fields = ProductListingSerializer.parse_fields(
+            request.query_params.get("fields"))
+        # one query for the whole batch, unknown or unapproved ids are skipped
+        products = ProductListingSerializer.project(
+            ProductListing.objects.all(), fields).in_bulk(ids)
+        cards = [products[pk] for pk in ids if pk in products]
+        return Response(ProductListingSerializer(cards, many=True, fields=fields).data)
+
+
+class ProductSearchView(generics.GenericAPIView):
+    authentication_classes = []
+    permission_classes = []
+    pagination_class = SearchPagination
+
+    def get(self, request):
+        q = request.query_params.get("q", "").strip()
+        if not q:
+            raise exceptions.ValidationError({"q": "search query is required"})
+        fields = ProductListingSerializer.parse_fields(
+            request.query_params.get("fields"))
+        query = SearchQuery(q, search_type="websearch", config=SEARCH_CONFIG)
+        # the match runs on the GIN index of search_vector, the cards come from the listing table
+        products = ProductListing.objects.filter(
+            product_identity__search_vector=query
+        ).annotate(
+            rank=SearchRank(F("product_identity__search_vector"), query)
+        ).order_by("-rank", "pk")
+        products = ProductListingSerializer.project(products, fields)
+        page = self.paginate_queryset(products)
+        serializer = ProductListingSerializer(page, many=True, fields=fields)
+        return self.get_paginated_response(serializer.data)
+
+
+class ProductFilterView(generics.GenericAPIView):
+    authentication_classes = []
+    permission_classes = []
+    pagination_class = ProductCursorPagination
+
+    def get(self, request):
+        filters = ProductFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        fields = ProductListingSerializer.parse_fields(
+            request.query_params.get("fields"))
+        products = filters.filter(ProductListing.objects.all())
+        page = self.paginate_queryset(
+            ProductListingSerializer.project(products, fields))
+        serializer = ProductListingSerializer(page, many=True, fields=fields)
+        response = self.get_paginated_response(serializer.data)
+        # the unfiltered catalog reads the precomputed counters,
+        # a filtered one is grouped on the listing table alone (no joins)
+        if filters.is_filtered:
+            response.data["facets"] = count_facets(products)
         else:
-            products = ProductIdentity.objects.filter(status="approved")
-            serializer = ProductSerializer(products, many=True)
-            return Response(serializer.data)
+            response.data["facets"] = stored_facets()
+        return response
 
 
 class AddToCartView(generics.GenericAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+    # anonymous shoppers get a cart in the cache, see storefront.cart
+    permission_classes = [permissions.AllowAny]
     serializer_class = AddToCartSerializer
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if not self.request.user.is_authenticated:
+            context["session_cart"] = self.session_cart
+        return context
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.session_cart = None if request.user.is_authenticated else SessionCart(request)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if getattr(self, "session_cart", None) is not None:
+            self.session_cart.set_cookie(response)
+        return super().finalize_response(request, response, *args, **kwargs)
+
     def post(self, request, format=None):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def get(self, request, format=None):
-        try:
-            instance = Cart.objects.get(user=request.user)
-        except Cart.DoesNotExist:
-            return Response({"detail": "Cart is empty."},)
-        serializer = ViewCartSerializer(instance)
-        return Response(serializer.data)
+        if self.session_cart is not None:
+            instance = self.session_cart
+            if not instance.items:
+                return Response(ViewCartSerializer(instance).data)
+        else:
+            try:
+                instance = Cart.objects.get(user=request.user)
+            except Cart.DoesNotExist:
+                return Response({"detail": "Cart is empty."},)
+        # the etag is also the version of the cached price, an unchanged cart is served as is
+        etag, last_modified = cart_validators(instance)
+        not_modified = conditional_get(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        serializer = ViewCartSerializer(instance, context={"etag": etag})
+        return set_validators(Response(serializer.data), etag, last_modified)
 
     def put(self, request, format=None):
         serializer = CountUpdateSerializer(
-            data=request.data, context={'request': request})
+            data=request.data, context=self.get_serializer_context())
         serializer.is_valid(raise_exception=True)
-        instance = Cart.objects.get(user=request.user)
+        if self.session_cart is not None:
+            instance = self.session_cart
+        else:
+            instance = Cart.objects.get(user=request.user)
         serializer = ViewCartSerializer(instance)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def delete(self, request):
-        cart = Cart.objects.get(user=request.user)
-        cart.items = {}
-        cart.save()
+        if self.session_cart is not None:
+            self.session_cart.clear()
+        else:
+            CartLine.objects.filter(cart__user=request.user).delete()
         return Response({"detail": "Cart cleared."}, status=status.HTTP_200_OK)
 
 
-class CheckoutView(APIView):
-
-    def post(self, request):
-        user = request.user
-        instance = Checkout.objects.get(user=user, status="pending").exists()
-        if instance.exists():
-            instance.status = "abandoned"
-            instance.save()
-
-        time_stamp = get_timestamp(settings.checkout_expiration)
-        update_customer_address(user)
-        line_items, checkout_items = get_line_items(user)
-        shipping_options, shipping_address_collection = get_shipping_cost(user)
-        session = stripe.checkout.Session.create(
-            automatic_tax={"enabled": True},
-            customer=user.customer.customer_id,
-            line_items=line_items,
-            mode="payment",
-            ui_mode="embedded",
-            return_url="https://example.com/return",
-            saved_payment_method_options={"payment_method_save": "enabled"},
-            shipping_options=shipping_options,
-            shipping_address_collection=shipping_address_collection,
-            expires_at=time_stamp,
-            allow_promotion_codes=True,
-        )
-        line_items_stripe = stripe.checkout.Session.list_line_items(
-            session.id,
-            limit=100
-        ).data
-        checkout_instance = create_checkout_instance(
-            user, session, line_items_stripe, checkout_items)
-        # would you return the checkout instance
-        # if yes then you need serializer for checkout instance with checkout items
-        return Response({"clientSecret": session.client_secret, "Checkout": CheckoutSerializer(checkout_instance).data}, status=status.HTTP_200_OK)
+@method_decorator(csrf_exempt, name="dispatch")  # enforced by SessionAuthentication like on the other views
+class CheckoutView(View):
+    """
+    async so the stripe round trips don't hold a worker of the asgi server, the database work runs in threads
+    """
+
+    async def post(self, request):
+        try:
+            user = await sync_to_async(authenticate)(request)
+            checkout = await sync_to_async(prepare_checkout)(
+                user, request.headers.get("Idempotency-Key", ""))
+            if "response" in checkout:
+                return JsonResponse(checkout["response"], status=status.HTTP_200_OK)
+            http_client = stripe.AIOHTTPClient()
+            client = get_stripe_client(http_client)
+            try:
+                data = await open_checkout(client, user, checkout)
+            finally:
+                # stored or failed, a later checkout of the same cart must not replay this session
+                await cache.adelete(checkout["attempt"])
+                await http_client.close_async()
+        except exceptions.APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, dict) else {"detail": exc.detail}
+            return JsonResponse(detail, status=exc.status_code)
+        except stripe.IdempotencyError:
+            # same key with other parameters, the first request is still being handled
+            return JsonResponse({"detail": "A checkout for this cart is already in progress."},
+                                status=status.HTTP_409_CONFLICT)
+        except stripe.StripeError:
+            # unreachable, rate limited or refused, nothing was kept on either side
+            logger.warning("checkout of user %s failed on stripe", user.pk, exc_info=True)
+            return JsonResponse({"detail": PaymentProviderException.default_detail},
+                                status=status.HTTP_502_BAD_GATEWAY)
+        return JsonResponse(data, status=status.HTTP_200_OK)
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_paymentmethod_funding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='state',
+            field=models.CharField(default='', max_length=100),
+            preserve_default=False,
+        ),
+    ]
@@ -34,6 +34,7 @@ from allauth.socialaccount.providers.oauth2.client import OAuth2Client
 from dj_rest_auth.registration.views import SocialLoginView
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from storefront.cart import merge_session_cart, forget_session_cart
 User = get_user_model()
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -170,6 +171,12 @@ class UserLoginAPIView(LoginView):
         else:
             return api_settings.LOGIN_SERIALIZER
 
+    def get_response(self):
+        response = super().get_response()
+        # whatever was put in the cart before signing in is kept
+        merge_session_cart(self.request, self.user)
+        return forget_session_cart(response)
+
 
 
 class CustomizedPasswordResetView(PasswordResetView):